@@ -0,0 +1,491 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import sqlite3
+import sys
+import os
+import argparse
+import hashlib
+import random
+import bisect
+import plistlib
+import struct
+import zlib
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+import message_backup
+
+# resource is only used to report the peak memory usage of the exports, and doesn't exist on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Builds synthetic iOS backups (sms.db, Manifest.db and the hashed attachment files) of any size and times message_backup.py against them,
+# so the exporter can be measured (and regressions caught) without a real phone backup.
+#
+#     python3 benchmark.py --messages 1000000 --groups 500 --output results.json
+#     python3 benchmark.py --baseline results.json -- --jobs 4
+#
+# Anything after `--` is passed on to message_backup.py.
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time message_backup.py against a synthetic iOS backup. Anything after `--` is passed on to message_backup.py.")
+    parser.add_argument("-b", "--backup", help="Where to put the synthetic backup. If it already holds a backup it is used as it is (so big backups only have to be generated once). If you don't specify a path, a temporary backup is generated and thrown away afterwards.",
+                    type=str)
+    parser.add_argument("--generate-only", help="Generate the backup (in --backup) and stop.",
+                    action="store_true")
+    parser.add_argument("-m", "--messages", help="Number of messages. (Default: 100000)",
+                    type=int, default=100000)
+    parser.add_argument("--contacts", help="Number of contacts, each with their own conversation. (Default: 200)",
+                    type=int, default=200)
+    parser.add_argument("--groups", help="Number of group chats. (Default: 20)",
+                    type=int, default=20)
+    parser.add_argument("--group-share", help="Fraction of the messages which are sent in group chats. (Default: 0.3)",
+                    type=float, default=0.3)
+    parser.add_argument("--attachment-rate", help="Fraction of the messages with an attachment. (Default: 0.05)",
+                    type=float, default=0.05)
+    parser.add_argument("--attachment-size", help="Average size of an attachment in KB. (Default: 32)",
+                    type=int, default=32)
+    parser.add_argument("--missing-rate", help="Fraction of the attachments which aren't in the backup (as if they were deleted from the phone). (Default: 0.02)",
+                    type=float, default=0.02)
+    parser.add_argument("--late-sync-rate", help="Fraction of the messages which were synced late (older history downloaded from iCloud after newer messages), so their ROWIDs are higher than those of newer messages. (Default: 0)",
+                    type=float, default=0.0)
+    parser.add_argument("--no-manifest", help="Generate an old-style backup without a Manifest.db.",
+                    action="store_true")
+    parser.add_argument("--seed", help="Seed of the random generator, so the same options always give the same backup. (Default: 1)",
+                    type=int, default=1)
+    parser.add_argument("-r", "--repeat", help="Number of times to run the export. The fastest run is reported. (Default: 1)",
+                    type=int, default=1)
+    parser.add_argument("-o", "--output", help="Save the results to this json file (e.g. to use as a --baseline later).",
+                    type=str)
+    parser.add_argument("--baseline", help="Results of an earlier run (from --output) to compare against. Exits with status 1 if this run is slower or uses more memory than the baseline by more than --tolerance.",
+                    type=str)
+    parser.add_argument("--tolerance", help="How much worse than the baseline a run may be before it counts as a regression. (Default: 0.1, i.e. 10%%)",
+                    type=float, default=0.1)
+    parser.add_argument("-v", "--verbose", help="Show the output of message_backup.py.",
+                    action="store_true")
+    argv = sys.argv[1:]
+    export_args = argv[argv.index('--') + 1:] if '--' in argv else []
+    args = parser.parse_args(argv[:argv.index('--')] if '--' in argv else argv)
+
+    temporary_directory = tempfile.mkdtemp(prefix='message_backup_benchmark_')
+    try:
+        backup_path = args.backup if args.backup is not None else temporary_directory + '/backup'
+        if os.path.exists(backup_path + '/' + sms_db_filename()):
+            print('Using the existing backup in ' + backup_path)
+        else:
+            print('Generating a backup with ' + str(args.messages) + ' messages...')
+            start = time.perf_counter()
+            generate_backup(backup_path, args.messages, args.contacts, args.groups, args.group_share, args.attachment_rate, args.attachment_size * 1024,
+                            args.missing_rate, args.late_sync_rate, manifest=not args.no_manifest, seed=args.seed)
+            print('Generated in %.1fs' % (time.perf_counter() - start))
+        if args.generate_only:
+            return
+
+        results = run_benchmark(backup_path, temporary_directory, export_args, args.repeat, args.verbose)
+    finally:
+        shutil.rmtree(temporary_directory)
+
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+        if not compare_results(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+# Path of sms.db within a backup (see message_backup.SMS_DB_DOMAIN_PATH)
+def sms_db_filename():
+    hashed_filename = hashlib.sha1(message_backup.SMS_DB_DOMAIN_PATH.encode('utf-8')).hexdigest()
+    return hashed_filename[:2] + '/' + hashed_filename
+
+
+# The tables of sms.db that the exporter reads, with the columns (and indexes) they have in iOS 11+ backups. Most of the columns the exporter
+# never looks at are left out, but not the blobs (message.attributedBody, the attachments' plists and iCloud sync tokens), which make the rows
+# as big as they are on a phone
+SMS_DB_SCHEMA = """
+    CREATE TABLE _SqliteDatabaseProperties (key TEXT, value TEXT, UNIQUE(key));
+    CREATE TABLE handle (ROWID INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE, id TEXT NOT NULL, country TEXT, service TEXT NOT NULL, uncanonicalized_id TEXT, person_centric_id TEXT, UNIQUE (id, service));
+    CREATE TABLE chat (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, guid TEXT UNIQUE NOT NULL, style INTEGER, state INTEGER, account_id TEXT, properties BLOB, chat_identifier TEXT,
+                       service_name TEXT, room_name TEXT, account_login TEXT, is_archived INTEGER DEFAULT 0, last_addressed_handle TEXT, display_name TEXT, group_id TEXT);
+    CREATE TABLE message (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, guid TEXT UNIQUE NOT NULL, text TEXT, replace INTEGER DEFAULT 0, service_center TEXT, handle_id INTEGER DEFAULT 0,
+                          subject TEXT, country TEXT, attributedBody BLOB, version INTEGER DEFAULT 0, type INTEGER DEFAULT 0, service TEXT, account TEXT, account_guid TEXT,
+                          error INTEGER DEFAULT 0, date INTEGER, date_read INTEGER, date_delivered INTEGER, is_delivered INTEGER DEFAULT 0, is_finished INTEGER DEFAULT 0,
+                          is_emote INTEGER DEFAULT 0, is_from_me INTEGER DEFAULT 0, is_empty INTEGER DEFAULT 0, is_read INTEGER DEFAULT 0, is_sent INTEGER DEFAULT 0,
+                          has_dd_results INTEGER DEFAULT 0, cache_has_attachments INTEGER DEFAULT 0, cache_roomnames TEXT, group_title TEXT, group_action_type INTEGER DEFAULT 0,
+                          associated_message_guid TEXT, associated_message_type INTEGER DEFAULT 0, balloon_bundle_id TEXT, expressive_send_style_id TEXT,
+                          message_summary_info BLOB);
+    CREATE TABLE chat_handle_join (chat_id INTEGER REFERENCES chat (ROWID) ON DELETE CASCADE, handle_id INTEGER REFERENCES handle (ROWID) ON DELETE CASCADE, UNIQUE(chat_id, handle_id));
+    CREATE TABLE chat_message_join (chat_id INTEGER REFERENCES chat (ROWID) ON DELETE CASCADE, message_id INTEGER REFERENCES message (ROWID) ON DELETE CASCADE, message_date INTEGER DEFAULT 0,
+                                    PRIMARY KEY (chat_id, message_id));
+    CREATE TABLE attachment (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, guid TEXT UNIQUE NOT NULL, created_date INTEGER DEFAULT 0, start_date INTEGER DEFAULT 0, filename TEXT, uti TEXT,
+                             mime_type TEXT, transfer_state INTEGER DEFAULT 0, is_outgoing INTEGER DEFAULT 0, user_info BLOB, transfer_name TEXT, total_bytes INTEGER DEFAULT 0,
+                             is_sticker INTEGER DEFAULT 0, sticker_user_info BLOB, attribution_info BLOB, hide_attachment INTEGER DEFAULT 0, ck_sync_state INTEGER DEFAULT 0,
+                             ck_server_change_token_blob BLOB, ck_record_id TEXT, original_guid TEXT UNIQUE NOT NULL, sr_ck_sync_state INTEGER DEFAULT 0,
+                             sr_ck_server_change_token_blob BLOB, sr_ck_record_id TEXT, is_commsafety_sensitive INTEGER DEFAULT 0, preview_generation_state INTEGER DEFAULT 0);
+    CREATE TABLE message_attachment_join (message_id INTEGER REFERENCES message (ROWID) ON DELETE CASCADE, attachment_id INTEGER REFERENCES attachment (ROWID) ON DELETE CASCADE,
+                                          UNIQUE(message_id, attachment_id));
+    CREATE INDEX message_idx_handle ON message(handle_id, date);
+    CREATE INDEX message_idx_is_read ON message(is_read, is_from_me, is_finished);
+    CREATE INDEX chat_message_join_idx_message_id_only ON chat_message_join(message_id);
+    CREATE INDEX chat_message_join_idx_message_date_id_chat_id ON chat_message_join(chat_id, message_date, message_id);
+    CREATE INDEX message_attachment_join_idx_message_id ON message_attachment_join(message_id);
+    CREATE INDEX message_attachment_join_idx_attachment_id ON message_attachment_join(attachment_id);
+"""
+
+# Words the messages are made up of (with a few accents and emoji, which the export has to handle too)
+WORDS = ('the be to of and a in that have I it for not on with he as you do at this but his by from they we say her she or an will my one all would '
+         'there their what so up out if about who get which go me when make can like time no just him know take people into year your good some '
+         'could them see other than then now look only come its over think also back after use two how our work first well way even new want '
+         'dinner tonight tomorrow running late haha lol ok okay sure thanks love call later meeting coffee pizza movie weekend birthday party '
+         'café naïve jalapeño über señor 😂 ❤️ 👍 🎉').split()
+
+# Attachment types: (mime type, uti, extension, weight)
+ATTACHMENT_TYPES = [('image/jpeg', 'public.jpeg', 'JPG', 50), ('image/png', 'public.png', 'PNG', 15), ('video/quicktime', 'com.apple.quicktime-movie', 'MOV', 10),
+                    ('video/mp4', 'public.mpeg-4', 'mp4', 5), ('application/pdf', 'com.adobe.pdf', 'pdf', 5), ('text/vcard', 'public.vcard', 'vcf', 5),
+                    ('image/gif', 'com.compuserve.gif', 'GIF', 5), (None, 'public.data', 'pluginPayloadAttachment', 5)]
+
+# Apple's timestamps count from 1/1/2001 (in nanoseconds). The synthetic messages start on 1/1/2015
+APPLE_EPOCH = 978307200
+FIRST_MESSAGE_DATE = (1420070400 - APPLE_EPOCH) * 1000000000
+
+# Messages are generated and inserted in chunks of this many, so millions of messages don't have to be held in memory
+CHUNK_SIZE = 20000
+
+# Average number of messages synced late in one go (see --late-sync-rate)
+LATE_SYNC_RUN = 50
+
+
+# Generates a synthetic iOS backup
+## backup_path: folder to create the backup in
+## messages: number of messages
+## contacts: number of contacts, each with their own conversation
+## groups: number of group chats
+## group_share: fraction of the messages which are sent in group chats
+## attachment_rate: fraction of the messages with an attachment
+## attachment_size: average size of an attachment in bytes
+## missing_rate: fraction of the attachments which aren't in the backup
+## late_sync_rate: fraction of the messages which were synced late, so their ROWIDs are higher than those of newer messages
+## manifest: whether to write a Manifest.db (iOS 10+ backups) listing every file with its size
+## seed: seed of the random generator
+### returns: nothing
+def generate_backup(backup_path, messages, contacts, groups, group_share=0.3, attachment_rate=0.05, attachment_size=32768, missing_rate=0.02, late_sync_rate=0.0, manifest=True, seed=1):
+    rng = random.Random(seed)
+    os.makedirs(backup_path + '/' + os.path.dirname(sms_db_filename()), exist_ok=True)
+    sms_db = sqlite3.connect(backup_path + '/' + sms_db_filename())
+    sms_db.executescript(SMS_DB_SCHEMA)
+
+    # Contacts are mostly phone numbers, some are apple ids. Some contacts also have an SMS handle next to their iMessage one
+    handles = []
+    for number in range(contacts):
+        handle_id = '+1555%07d' % number if number % 10 else 'contact%d@example.com' % number
+        handles.append((len(handles) + 1, handle_id, 'iMessage'))
+        if number % 7 == 0 and handle_id[0] == '+':
+            handles.append((len(handles) + 1, handle_id, 'SMS'))
+    sms_db.executemany('INSERT INTO handle (ROWID, id, country, service, uncanonicalized_id) VALUES (?, ?, \'us\', ?, NULL);', handles)
+
+    # One conversation per handle and the group chats: (chat ROWID, room_name, handle ROWIDs of the other people in it)
+    chats = []
+    for handle_rowid, handle_id, service in handles:
+        chats.append((len(chats) + 1, None, [handle_rowid]))
+        sms_db.execute('INSERT INTO chat (ROWID, guid, style, state, chat_identifier, service_name) VALUES (?, ?, 45, 3, ?, ?);',
+                       (len(chats), service + ';-;' + handle_id, handle_id, service))
+    single_chats = len(chats)
+    imessage_handles = [handle[0] for handle in handles if handle[2] == 'iMessage']
+    for number in range(groups):
+        room_name = 'chat%018d' % rng.randrange(10 ** 18)
+        members = rng.sample(imessage_handles, min(len(imessage_handles), rng.randint(2, 8)))
+        chats.append((len(chats) + 1, room_name, members))
+        sms_db.execute('INSERT INTO chat (ROWID, guid, style, state, chat_identifier, service_name, room_name, display_name) VALUES (?, ?, 43, 3, ?, \'iMessage\', ?, ?);',
+                       (len(chats), 'iMessage;+;' + room_name, room_name, room_name, ''))
+        sms_db.executemany('INSERT INTO chat_handle_join VALUES (?, ?);', [(len(chats), member) for member in members])
+    handle_services = {handle[0]: handle[2] for handle in handles}
+    # Group chats which were given a name (the others are 'untitled' in the export)
+    group_names = {chat[1]: 'Group ' + str(number) for number, chat in enumerate(chats[single_chats:]) if number % 3}
+
+    # Some conversations are much busier than others
+    single_weights = cumulative_weights(single_chats, 1 - group_share if groups else 1)
+    group_weights = cumulative_weights(groups, group_share) if groups else []
+    weights = single_weights + [single_weights[-1] + weight for weight in group_weights]
+
+    # Every attachment file: filename in sms.db -> (size, attachment type), and the filenames in the order they were first sent
+    attachment_files = {}
+    attachment_filenames = []
+    date = FIRST_MESSAGE_DATE
+    attachment_rowid = 0
+    # Messages left in the current run of late-synced messages, the conversation they're in and the date of the last one
+    late_messages, late_chat, late_date = 0, None, None
+    for chunk_start in range(0, messages, CHUNK_SIZE):
+        message_rows = []
+        chat_message_rows = []
+        attachment_rows = []
+        message_attachment_rows = []
+        for message_rowid in range(chunk_start + 1, min(chunk_start + CHUNK_SIZE, messages) + 1):
+            if not late_messages and rng.random() < late_sync_rate / LATE_SYNC_RUN:
+                # Part of a conversation's older history turns up now: it gets the next ROWIDs but goes back to an earlier date
+                late_messages = 1 + int(rng.expovariate(1.0 / LATE_SYNC_RUN))
+                late_chat = chats[bisect.bisect(weights, rng.random() * weights[-1])]
+                late_date = rng.randint(FIRST_MESSAGE_DATE, date)
+            if late_messages:
+                late_messages -= 1
+                chat_rowid, room_name, members = late_chat
+                late_date += int(rng.expovariate(1.0 / 600) * 1000000000) + 1
+                message_date = late_date
+            else:
+                chat_rowid, room_name, members = chats[bisect.bisect(weights, rng.random() * weights[-1])]
+                date += int(rng.expovariate(1.0 / 600) * 1000000000) + 1
+                message_date = date
+            is_from_me = rng.random() < 0.5
+            handle_rowid = 0 if is_from_me and room_name is not None else rng.choice(members)
+            service = handle_services.get(handle_rowid, 'iMessage') if room_name is None else 'iMessage'
+            group_title = group_names.get(room_name) if room_name is not None and rng.random() < 0.01 else None
+
+            has_attachment = rng.random() < attachment_rate
+            if has_attachment:
+                text = '￼' if rng.random() < 0.8 else random_text(rng) + ' ￼'
+                for number in range(1 if rng.random() < 0.9 else rng.randint(2, 4)):
+                    attachment_rowid += 1
+                    if attachment_files and rng.random() < 0.05:
+                        # A forwarded attachment, which is the same file as an earlier one
+                        filename = rng.choice(attachment_filenames[-1000:])
+                        size, (mime_type, uti, extension, weight) = attachment_files[filename]
+                    else:
+                        mime_type, uti, extension, weight = rng.choices(ATTACHMENT_TYPES, [attachment_type[3] for attachment_type in ATTACHMENT_TYPES])[0]
+                        filename = '~/Library/SMS/Attachments/%02x/%02d/%08X-%04X/IMG_%04d.%s' % (attachment_rowid % 256, attachment_rowid % 100, attachment_rowid, number, attachment_rowid % 10000, extension)
+                        size = max(64, int(rng.expovariate(1.0 / attachment_size)))
+                        attachment_files[filename] = (size, (mime_type, uti, extension, weight))
+                        attachment_filenames.append(filename)
+                    guid = 'at_%d_%d' % (message_rowid, number)
+                    is_sticker = mime_type == 'image/png' and rng.random() < 0.2
+                    # Most attachments are kept in iCloud, which leaves a record id and a change token for each of its two sync passes
+                    synced = rng.random() < 0.7
+                    attachment_rows.append((attachment_rowid, guid, message_date // 1000000000, message_date // 1000000000, filename, uti, mime_type, 5,
+                                            int(is_from_me), os.path.basename(filename), size, int(is_sticker), sticker_user_info(rng) if is_sticker else None,
+                                            attribution_info(rng) if mime_type is not None and mime_type[:5] in ('image', 'video') else None,
+                                            int(synced), change_token(rng) if synced else None, '%064x' % rng.getrandbits(256) if synced else None, guid,
+                                            int(synced), change_token(rng) if synced else None, '%064x' % rng.getrandbits(256) if synced else None))
+                    message_attachment_rows.append((message_rowid, attachment_rowid))
+            elif rng.random() < 0.02:
+                # Messages without any text (e.g. tapbacks on older phones)
+                text = None
+            else:
+                text = random_text(rng)
+
+            message_rows.append((message_rowid, 'M%08d-%04X' % (message_rowid, chat_rowid), text, attributed_body(text) if text is not None else None, handle_rowid, service,
+                                 message_date, message_date + 1000000000 if not is_from_me else 0, message_date + 500000000 if is_from_me else 0, int(is_from_me),
+                                 int(has_attachment), room_name, group_title, MESSAGE_SUMMARY_INFO))
+            chat_message_rows.append((chat_rowid, message_rowid, message_date))
+
+        sms_db.executemany('INSERT INTO message (ROWID, guid, text, attributedBody, handle_id, service, date, date_read, date_delivered, is_from_me, cache_has_attachments, cache_roomnames, '
+                           'group_title, message_summary_info, is_delivered, is_finished, is_sent, is_read) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, 1, 1, 1);', message_rows)
+        sms_db.executemany('INSERT INTO chat_message_join VALUES (?, ?, ?);', chat_message_rows)
+        sms_db.executemany('INSERT INTO attachment (ROWID, guid, created_date, start_date, filename, uti, mime_type, transfer_state, is_outgoing, transfer_name, total_bytes, '
+                           'is_sticker, sticker_user_info, attribution_info, ck_sync_state, ck_server_change_token_blob, ck_record_id, original_guid, sr_ck_sync_state, '
+                           'sr_ck_server_change_token_blob, sr_ck_record_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);', attachment_rows)
+        sms_db.executemany('INSERT INTO message_attachment_join VALUES (?, ?);', message_attachment_rows)
+    sms_db.commit()
+    sms_db.close()
+
+    # Write the attachment files under their hashed names (see message_backup.BackupManifest), leaving some out
+    manifest_rows = [(hashlib.sha1(message_backup.SMS_DB_DOMAIN_PATH.encode('utf-8')).hexdigest(), 'HomeDomain', 'Library/SMS/sms.db', 1,
+                      manifest_file_info(os.path.getsize(backup_path + '/' + sms_db_filename())))]
+    filler = bytes(rng.getrandbits(8) for byte in range(65536))
+    for filename, (size, (mime_type, uti, extension, weight)) in attachment_files.items():
+        if rng.random() < missing_rate:
+            continue
+        domain_path = filename.replace('~/Library', 'MediaDomain-Library')
+        hashed_filename = hashlib.sha1(domain_path.encode('utf-8')).hexdigest()
+        os.makedirs(backup_path + '/' + hashed_filename[:2], exist_ok=True)
+        with open(backup_path + '/' + hashed_filename[:2] + '/' + hashed_filename, 'wb') as attachment_file:
+            # Images are real (tiny) images padded out to size, so thumbnails can be made of them. Everything else is just data
+            data = small_png(rng) if mime_type is not None and mime_type[:5] == 'image' else b''
+            attachment_file.write(data)
+            for offset in range(len(data), size, len(filler)):
+                attachment_file.write(filler[:size - offset])
+        manifest_rows.append((hashed_filename, 'MediaDomain', filename[len('~/'):], 1, manifest_file_info(max(size, len(data)))))
+
+    if manifest:
+        manifest_db = sqlite3.connect(backup_path + '/Manifest.db')
+        manifest_db.executescript('CREATE TABLE Files (fileID TEXT PRIMARY KEY, domain TEXT, relativePath TEXT, flags INTEGER, file BLOB);'
+                                  'CREATE INDEX FilesDomainIdx ON Files(domain); CREATE INDEX FilesRelativePathIdx ON Files(relativePath); CREATE INDEX FilesFlagsIdx ON Files(flags);'
+                                  'CREATE TABLE Properties (key TEXT PRIMARY KEY, value BLOB);')
+        manifest_db.executemany('INSERT INTO Files VALUES (?, ?, ?, ?, ?);', manifest_rows)
+        manifest_db.commit()
+        manifest_db.close()
+
+
+# Splits a share of the messages between conversations so a few are busy and most are quiet (like a real phone)
+## count: number of conversations
+## share: total weight of these conversations
+### returns: list of cumulative weights, one per conversation
+def cumulative_weights(count, share):
+    weights = [1.0 / (rank + 1) for rank in range(count)]
+    total = sum(weights)
+    cumulative = []
+    running = 0.0
+    for weight in weights:
+        running += weight / total * share
+        cumulative.append(running)
+    return cumulative
+
+
+# A message of a few random words
+def random_text(rng):
+    return ' '.join(rng.choice(WORDS) for word in range(min(60, 1 + int(rng.expovariate(1.0 / 8)))))
+
+
+# The 'file' blob of a Manifest.db entry: an MBFile (the exporter only reads its Size)
+def manifest_file_info(size):
+    return keyed_archive('MBFile', {'Size': size, 'Mode': 33188, 'Flags': 0, 'LastModified': 1500000000, 'Birth': 1500000000, 'ProtectionClass': 3, 'UserID': 501,
+                                    'GroupID': 501, 'InodeNumber': 0, 'RelativePath': plistlib.UID(0)})
+
+
+# An NSKeyedArchiver plist of one object, the way iOS stores most of the blobs in its databases
+## class_name: the object's class
+## fields: the object's fields
+def keyed_archive(class_name, fields):
+    return plistlib.dumps({'$version': 100000, '$archiver': 'NSKeyedArchiver', '$top': {'root': plistlib.UID(1)},
+                           '$objects': ['$null', dict({'$class': plistlib.UID(2)}, **fields), {'$classname': class_name, '$classes': [class_name, 'NSObject']}]},
+                          fmt=plistlib.FMT_BINARY)
+
+
+# message.attributedBody: the text as an NSAttributedString in Apple's typedstream format, with the one attribute every message part has
+def attributed_body(text):
+    def length(value):
+        return bytes([value]) if value < 0x80 else b'\x81' + struct.pack('<H', value)
+    data = text.encode('utf-8')
+    return (b'\x04\x0bstreamtyped\x81\xe8\x03\x84\x01@\x84\x84\x84\x12NSAttributedString\x00\x84\x84\x08NSObject\x00\x85\x92\x84\x84\x84\x08NSString\x01\x94\x84\x01+' +
+            length(len(data)) + data + b'\x86\x84\x02iI\x01' + length(len(text.encode('utf-16-le')) // 2) +
+            b'\x92\x84\x84\x84\x0cNSDictionary\x00\x94\x84\x01i\x01\x92\x84\x96\x96\x1d__kIMMessagePartAttributeName\x86\x92\x84\x84\x84\x08NSNumber\x00'
+            b'\x84\x84\x07NSValue\x00\x94\x84\x01*\x84\x99\x99\x00\x86\x86\x86')
+
+
+# message.message_summary_info: a small plist which (almost) every message on a recent phone has
+MESSAGE_SUMMARY_INFO = plistlib.dumps({'amc': 1, 'ust': True, 'ams': '', 'amsa': 'com.apple.messages'}, fmt=plistlib.FMT_BINARY)
+
+
+# attachment.ck_server_change_token_blob (and sr_ck_server_change_token_blob): the CKServerChangeToken of the attachment's last iCloud sync
+def change_token(rng):
+    return keyed_archive('CKServerChangeToken', {'ChangeTokenData': bytes(rng.getrandbits(8) for byte in range(rng.randint(40, 120)))})
+
+
+# attachment.attribution_info: where a photo or video came from and its size
+def attribution_info(rng):
+    return plistlib.dumps({'pgenii': 0, 'pgensh': rng.choice([1080, 1440, 3024]), 'pgensw': rng.choice([1920, 2560, 4032]), 'pgenb': rng.random() < 0.1,
+                           'bundleID': 'com.apple.mobileslideshow'}, fmt=plistlib.FMT_BINARY)
+
+
+# attachment.sticker_user_info: the sticker pack a sticker came from and where it was placed on the message
+def sticker_user_info(rng):
+    return keyed_archive('NSDictionary', {'pid': 'com.apple.messages.StickerPack.%08X' % rng.getrandbits(32), 'sid': '%032x' % rng.getrandbits(128),
+                                          'ai': 'com.apple.Stickers.UserGenerated.MessagesExtension', 'sxs': rng.random(), 'sys': rng.random(),
+                                          'sro': rng.uniform(-0.5, 0.5), 'ssa': rng.uniform(0.5, 1.5), 'spw': 375.0, 'sli': '%032x' % rng.getrandbits(128)})
+
+
+# A small solid-colour png image
+def small_png(rng, width=64, height=48):
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+    pixel = bytes([rng.randrange(256), rng.randrange(256), rng.randrange(256)])
+    rows = b''.join(b'\x00' + pixel * width for row in range(height))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+# Runs message_backup.py against a backup (in a separate process, so its memory use can be measured on its own) and measures it
+## backup_path: the backup to export
+## working_directory: folder to export into (each run goes in a new folder, which is removed afterwards)
+## export_args: extra arguments for message_backup.py
+## repeat: number of runs
+## verbose: show the output of message_backup.py
+### returns: dictionary of results (see print_results)
+def run_benchmark(backup_path, working_directory, export_args, repeat=1, verbose=False):
+    sms_db = sqlite3.connect(backup_path + '/' + sms_db_filename())
+    messages = sms_db.execute('SELECT COUNT(*) FROM message;').fetchone()[0]
+    sms_db.close()
+
+    runs = []
+    stages = {}
+    attachment_bytes = 0
+    for run in range(repeat):
+        destination_path = working_directory + '/export_' + str(run)
+        metrics_filename = destination_path + '.metrics.json'
+        command = [sys.executable, os.path.abspath(message_backup.__file__), '-b', backup_path, '-d', destination_path, '--metrics', metrics_filename] + export_args
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=None if verbose else subprocess.DEVNULL)
+        runs.append(time.perf_counter() - start)
+        print('Run ' + str(run + 1) + ': %.2fs' % runs[-1])
+
+        # Keep the time per stage of the fastest run
+        with open(metrics_filename, encoding='utf-8') as metrics_file:
+            metrics = json.load(metrics_file)
+        if runs[-1] == min(runs):
+            stages = metrics['stages']
+        attachment_bytes = folder_size(destination_path + '/attachments', exclude=[message_backup.THUMBNAILS_FOLDER])
+        shutil.rmtree(destination_path)
+        os.remove(metrics_filename)
+
+    # ru_maxrss is the peak of the biggest child process (which includes the --jobs workers, once they have been waited for). It's in KB on Linux and bytes on macOS
+    peak_rss_mb = None
+    if resource is not None:
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * (1 if sys.platform == 'darwin' else 1024) / 1048576.0
+    seconds = min(runs)
+    return {'messages': messages, 'attachment_bytes': attachment_bytes, 'export_args': export_args, 'runs': runs, 'seconds': seconds,
+            'messages_per_second': messages / seconds, 'attachment_mb_per_second': attachment_bytes / 1048576.0 / seconds, 'peak_rss_mb': peak_rss_mb,
+            'stages': stages}
+
+
+# Total size of the files in a folder (and its subfolders)
+## exclude: names of subfolders to leave out
+def folder_size(folder, exclude=()):
+    total = 0
+    for root, folders, filenames in os.walk(folder):
+        folders[:] = [name for name in folders if name not in exclude]
+        total += sum(os.path.getsize(os.path.join(root, filename)) for filename in filenames)
+    return total
+
+
+def print_results(results):
+    print('')
+    print('Messages:        %d' % results['messages'])
+    print('Export time:     %.2fs' % results['seconds'] + (' (fastest of %d runs)' % len(results['runs']) if len(results['runs']) > 1 else ''))
+    print('Messages/sec:    %.0f' % results['messages_per_second'])
+    print('Attachments:     %.1f MB/sec (%s)' % (results['attachment_mb_per_second'], message_backup.format_size(results['attachment_bytes'])))
+    print('Peak RSS:        ' + ('%.1f MB' % results['peak_rss_mb'] if results['peak_rss_mb'] is not None else 'unavailable'))
+    # Seconds spent in each stage of the export (see --metrics in message_backup.py)
+    if results.get('stages'):
+        print('Stages:')
+        for stage, seconds in results['stages'].items():
+            print('  %-17s%.2fs' % (stage + ':', seconds))
+
+
+# Compares results with a baseline
+## tolerance: how much worse than the baseline the results may be (0.1 = 10%)
+### returns: True if the results are no worse than the baseline, False (after printing what got worse) if they are
+def compare_results(results, baseline, tolerance):
+    regressions = []
+    if results['messages'] != baseline['messages'] or results['export_args'] != baseline['export_args']:
+        print('Warning: the baseline exported ' + str(baseline['messages']) + ' messages with ' + repr(baseline['export_args']) + ', so the comparison may be meaningless.')
+    if results['seconds'] > baseline['seconds'] * (1 + tolerance):
+        regressions.append('export time %.2fs -> %.2fs' % (baseline['seconds'], results['seconds']))
+    # Peak RSS can't be measured on Windows, so it's only compared when both sides have it
+    if results['peak_rss_mb'] is not None and baseline['peak_rss_mb'] is not None and results['peak_rss_mb'] > baseline['peak_rss_mb'] * (1 + tolerance):
+        regressions.append('peak RSS %.1f MB -> %.1f MB' % (baseline['peak_rss_mb'], results['peak_rss_mb']))
+    if regressions:
+        print('\nRegression: ' + ', '.join(regressions))
+        return False
+    print('\nNo regression (%.2fs vs %.2fs in the baseline)' % (results['seconds'], baseline['seconds']))
+    return True
+
+
+if __name__ == "__main__":
+    main()
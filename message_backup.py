@@ -9,306 +9,2465 @@ import os
 import glob
 import shutil
 import argparse
+import csv
+import itertools
+import json
+import time
+import threading
+import plistlib
+import concurrent.futures
+import multiprocessing
+import multiprocessing.connection
+import heapq
+import queue
+import traceback
+import urllib.parse
+import tempfile
+import subprocess
+import contextlib
+import io
+import cProfile
+
+# Pillow is only needed to make thumbnails of images. Without it the pages show the full-size images
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# resource is only used to report the peak memory usage in --metrics, and doesn't exist on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--destination", help="Specify the path where you want the messages backup files to be saved. If you don't specify a path, a directory will be created on the Desktop. (Example: `-d ~/Desktop/message_backup`)",
                     type=str)
-    parser.add_argument("-b", "--backup", help="Specify the path to the backup you want to use. If you don't specify a path, the latest iTunes iOS backup will be used. (Example: `-b /Users/NAME/Library/Application\ Support/MobileSync/Backup/7b93de038108pz5w6b30mr9271938mcy928g93yu`)")
+    parser.add_argument("-b", "--backup", help="Specify the path to the backup you want to use. If you don't specify a path, the latest iTunes iOS backup will be used. (Example: `-b /Users/NAME/Library/Application\ Support/MobileSync/Backup/7b93de038108pz5w6b30mr9271938mcy928g93yu`). With --all-backups: the folder holding the backups.")
+    parser.add_argument("--copy-workers", help="Number of background threads used to copy attachments out of the backup. (Default: 8)",
+                    type=int, default=8)
+    parser.add_argument("--link-mode", help="How attachments are placed in the destination. `hardlink` and `reflink` avoid copying the data when the destination is on the same filesystem as the backup, and fall back to a normal copy when that isn't possible. (Default: copy)",
+                    choices=['copy', 'hardlink', 'reflink'], default='copy')
+    parser.add_argument("-i", "--incremental", help="Update an existing archive instead of creating a new one. Only messages newer than the last export are appended to the html files and only new attachments are copied. An interrupted export is resumed where it left off.",
+                    action="store_true")
+    parser.add_argument("-j", "--jobs", help="Number of processes used to write the conversations. Each process reads the backup through its own read-only connection and writes its own share of the html files. (Default: 1)",
+                    type=int, default=1)
+    parser.add_argument("--working-copy", help="Copy sms.db out of the backup (into memory or a temporary file) and add indexes for the export's queries before exporting. `auto` does this when sms.db is bigger than --working-copy-threshold. (Default: auto)",
+                    choices=['auto', 'memory', 'file', 'off'], default='auto')
+    parser.add_argument("--working-copy-threshold", help="Size in MB above which `--working-copy auto` makes a working copy of sms.db. (Default: 64)",
+                    type=int, default=64)
+    parser.add_argument("--no-thumbnails", help="Don't make thumbnails of image and video attachments. (Thumbnails of images need Pillow, thumbnails of videos need ffmpeg)",
+                    action="store_true")
+    parser.add_argument("--all-backups", help="Export every iOS backup on this computer (or in the folder given with -b), each into an archive of its own in the destination (named after the backup's folder). The archives share one attachment store, and are updated incrementally when this is run again.",
+                    action="store_true")
+    parser.add_argument("--concurrent", help="With --all-backups, the number of backups exported at the same time, each in its own process. (Default: 2)",
+                    type=int, default=2)
+    parser.add_argument("--attachment-store", help="Put the attachments in a content-addressed store in this folder, shared by any number of archives, and only link to them from the archive's attachments folder, so each picture or video takes up space once however many backups and archives it is in. The store has to be on the same filesystem as the archives. (Default with --all-backups: `shared_attachments` in the destination)",
+                    type=str)
+    parser.add_argument("--io-budget", help="Maximum MB per second of attachment data read and written while copying attachments, e.g. to keep a nightly export from hogging the disk. With --all-backups and --jobs it is shared between the processes. (Default: no limit)",
+                    type=float)
+    parser.add_argument("--metrics", help="Save measurements of the export to this JSON file: messages/sec, time spent in each stage (query, extract, store, render_html, etc.), attachments copied and the slowest conversations. (Example: `--metrics metrics.json`)",
+                    type=str)
+    parser.add_argument("--profile", help="Profile the export with cProfile and save the profile to this file (and one file per process with --jobs, e.g. export.prof.worker0), to be read with `python3 -m pstats`. (Example: `--profile export.prof`)",
+                    type=str)
+    add_output_arguments(parser)
+    subparsers = parser.add_subparsers(dest='command')
+    render_parser = subparsers.add_parser('render', help="Write the conversations of an existing archive again from its message store (e.g. in another format) without reading the backup.")
+    render_parser.add_argument("-d", "--destination", help="The archive to render (the destination of a previous export).",
+                    type=str, required=True)
+    add_output_arguments(render_parser)
+    search_parser = subparsers.add_parser('search', help="Search the messages of an archive.")
+    search_parser.add_argument("-d", "--destination", help="The archive to search (the destination of a previous export).",
+                    type=str, required=True)
+    search_parser.add_argument("query", help="Words to search for. FTS5 query syntax is supported, e.g. `pizza NOT pineapple`, `\"happy birthday\"`, `birth*` or `sender:11234567890`.",
+                    nargs='+')
+    search_parser.add_argument("--after", help="Only search messages sent on or after this date (YYYY-MM-DD).",
+                    type=parse_date)
+    search_parser.add_argument("--before", help="Only search messages sent before this date (YYYY-MM-DD).",
+                    type=parse_date)
+    search_parser.add_argument("-n", "--limit", help="Maximum number of messages to show, newest first. (Default: 50)",
+                    type=int, default=50)
     args = parser.parse_args()
 
+    if args.command == 'render':
+        render_archive(args.destination, args.format, args.page_size)
+        return
+    if args.command == 'search':
+        search_archive(args.destination, ' '.join(args.query), args.after, args.before, args.limit)
+        return
+
+    if args.all_backups:
+        export_all_backups(args)
+        return
+    run_export(args)
+
+
+# Runs export_backup, under cProfile if --profile was given
+## args: the parsed command line (see main)
+## progress: ExportProgress for the export (None for one with a progress bar)
+## budget: IOBudget the export shares with others running at the same time (None for one of its own, if --io-budget was given)
+### returns: nothing
+def run_export(args, progress=None, budget=None):
+    if args.profile is None:
+        export_backup(args, progress, budget)
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(export_backup, args, progress, budget)
+    finally:
+        profiler.dump_stats(args.profile)
+        print('Profile saved to ' + args.profile + ' (read it with `python3 -m pstats ' + args.profile + '`)')
+
+
+# Exports every backup in a folder (by default every backup made on this computer), each into an archive of its own in the destination,
+# all sharing one AttachmentStore. Several backups are exported at once, biggest first, each in its own process, all taking turns from one
+# I/O budget. The exports are incremental, so running this again (e.g. every night) only adds what is new to each archive
+## args: the parsed command line (see main)
+### returns: nothing
+def export_all_backups(args):
+    backups_folder = args.backup if args.backup is not None else MOBILESYNC_BACKUP_FOLDER
+    backups = find_iOS_backups(backups_folder)
+    if not backups:
+        print('Error: No backups found in ' + backups_folder + '.')
+        sys.exit()
+
+    # Get destination location from user or set to default as desktop. It is updated by later runs, so there's no date in its name
+    destination_path = args.destination if args.destination is not None else os.path.expanduser('~/Desktop') + '/iOS_messages_archives'
+    os.makedirs(destination_path, exist_ok=True)
+
+    # Nothing is being copied into the store yet, so the leftovers of copies cut off by an earlier run can go
+    store = AttachmentStore(args.attachment_store if args.attachment_store is not None else destination_path + '/' + SHARED_ATTACHMENTS_FOLDER)
+    store.remove_partial_files()
+
+    # Start with the biggest backups, so a long export doesn't start last
+    backups.sort(key=lambda backup_path: -get_backup_sms_db_size(backup_path))
+    total = len(backups)
+    concurrent = max(1, min(args.concurrent, total))
+    print('Exporting ' + str(total) + ' backups (' + str(concurrent) + ' at a time) into ' + destination_path + '...')
+
+    # However many exports are running (fewer towards the end), together they stay within --io-budget
+    budget = IOBudget(args.io_budget * 1024 * 1024) if args.io_budget else None
+    context = multiprocessing.get_context('spawn')
+    running = {}
+    # Connection from each running export -> its label, and label -> (messages written, messages to export) of each running export
+    updates = {}
+    progress = {}
+    failed = []
+    start_time = time.time()
+    while backups or running:
+        while backups and len(running) < concurrent:
+            backup_path = backups.pop(0)
+            name = os.path.basename(os.path.normpath(backup_path))
+            device_name = get_backup_device_name(backup_path)
+            label = name if device_name is None else device_name + ' (' + name + ')'
+            archive_path = destination_path + '/' + name
+            os.makedirs(archive_path, exist_ok=True)
+
+            backup_args = argparse.Namespace(**vars(args))
+            backup_args.backup = backup_path
+            backup_args.destination = archive_path
+            backup_args.incremental = True
+            backup_args.all_backups = False
+            backup_args.attachment_store = store.path
+            if args.metrics is not None:
+                metrics_root, metrics_extension = os.path.splitext(args.metrics)
+                backup_args.metrics = metrics_root + '.' + name + metrics_extension
+            if args.profile is not None:
+                backup_args.profile = args.profile + '.' + name
+
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=export_backup_logged, args=(backup_args, archive_path + '/' + EXPORT_LOG_FILENAME, sender, budget))
+            process.start()
+            # Only the export holds on to its end, so the parent's end reports EOF once the export is over
+            sender.close()
+            running[process.sentinel] = (process, label, archive_path, time.time(), receiver)
+            updates[receiver] = label
+            print_over_progress('Started ' + label)
+
+        for ready in multiprocessing.connection.wait(list(running) + list(updates)):
+            if ready in updates:
+                try:
+                    progress[updates[ready]] = ready.recv()
+                except EOFError:
+                    del updates[ready]
+                    ready.close()
+                else:
+                    draw_backups_progress(progress)
+                continue
+            process, label, archive_path, process_start, receiver = running.pop(ready)
+            process.join()
+            # Anything the export sent that hasn't been read yet doesn't matter any more
+            if updates.pop(receiver, None) is not None:
+                receiver.close()
+            progress.pop(label, None)
+            if process.exitcode == 0:
+                print_over_progress('Finished ' + label + ' in %.1fs' % (time.time() - process_start))
+            else:
+                print_over_progress('Failed to export ' + label + ' (see ' + archive_path + '/' + EXPORT_LOG_FILENAME + ')', file=sys.stderr)
+                failed.append(label)
+
+    files, total_size = store.usage()
+    store.close()
+    print('\nShared attachment store: ' + str(files) + ' files (' + format_size(total_size) + ') in ' + store.path)
+    print('Exported ' + str(total - len(failed)) + ' backups in %.1fs' % (time.time() - start_time))
+    if failed:
+        print('\nWarning: ' + str(len(failed)) + ' backups could not be exported: ' + ', '.join(failed), file=sys.stderr)
+    print('\nBackup Complete!\n')
+
+
+# Shows the progress of the exports export_all_backups is running as one progress bar, with how far each of them is
+## progress: label -> (messages written, messages to export) of each running export
+### returns: nothing
+def draw_backups_progress(progress):
+    done = sum(written for written, total in progress.values())
+    total = max(sum(total for written, total in progress.values()), 1)
+    suffix = '  '.join('%s %d%%' % (label, 100 * written // max(count, 1)) for label, (written, count) in sorted(progress.items()))
+    printProgressBar(min(done, total), total, prefix = 'Progress:', suffix = suffix.ljust(70), length = 40)
+
+
+# Prints a line over the progress bar (which is only followed by a newline once it's complete)
+def print_over_progress(text, file=sys.stdout):
+    print('\r' + text.ljust(PROGRESS_LINE_WIDTH), file=file)
+
+
+# Width of the progress bar's line (see ExportProgress.draw)
+PROGRESS_LINE_WIDTH = 130
+
+
+# Entry point of a process started by export_all_backups. Everything the export prints goes to a log file in its archive, with a line of
+# progress now and then rather than a progress bar, and the progress is sent on to export_all_backups to show
+## args: the parsed command line for this backup's export
+## log_filename: file to append the export's output to
+## updates: connection to send the progress to (see ExportProgress)
+## budget: IOBudget shared by all the exports (None for no limit)
+### returns: nothing (the process exits with status 1 if the export fails)
+def export_backup_logged(args, log_filename, updates, budget):
+    with open(log_filename, 'a', encoding='utf-8') as log_file:
+        sys.stdout = log_file
+        sys.stderr = log_file
+        print('\n' + datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') + ' Exporting ' + args.backup)
+        try:
+            run_export(args, ExportProgress(bar=False, updates=updates), budget)
+        except Exception:
+            traceback.print_exc()
+            sys.exit(1)
+
+
+# Exports the messages of a backup (everything main does apart from the render and search commands)
+## args: the parsed command line (see main)
+## progress: ExportProgress for the export (None for one with a progress bar)
+## budget: IOBudget the export shares with others running at the same time (None for one of its own, if --io-budget was given)
+### returns: nothing
+def export_backup(args, progress=None, budget=None):
     # Get destination location from user or set to default as desktop with today's date
     destination_path = args.destination if args.destination is not None else os.path.expanduser('~/Desktop') + '/iOS_messages_archive_' + datetime.datetime.now().strftime("%Y-%m-%d")
 
-    # If the destination directory doesn't already exist, create it!
+    # If the destination directory doesn't already exist, create it! (Unless we are adding to an existing archive)
     if not os.path.exists(destination_path):
         os.makedirs(destination_path)
-    else:
-        print('Error: Directory already exists. Please select a new location.')
+    elif not args.incremental:
+        print('Error: Directory already exists. Please select a new location (or use --incremental to update it).')
         sys.exit()
 
+    # Load the high-water marks of the previous export (if there was one)
+    state = ExportState(destination_path + '/' + EXPORT_STATE_FILENAME)
+
+    # Times each stage of the export, and shows the progress bar once the messages are being exported
+    if progress is None:
+        progress = ExportProgress()
+
     # lol. So many texts.
     print('Please wait... This may take a while...')
 
     # Get the path to the iOS backup file
     backup_path = args.backup if args.backup is not None else get_latest_iOS_backup_path()
 
-    # Connect to the sms.db file from the latest iOS backup. (3d0d7e5fb2ce288813306e4d4636395e047a3d28 is the sha1 hashed name for the sms.db file)
-    conn = sqlite3.connect(backup_path + '/3d/3d0d7e5fb2ce288813306e4d4636395e047a3d28')
-    db_cursor = conn.cursor()
+    # Load the backup's index of hashed files once, so finding an attachment is just a lookup
+    with progress.stage('manifest'):
+        manifest = BackupManifest(backup_path)
+
+    # Connect to the sms.db file from the latest iOS backup. Big databases are first copied to a working copy with indexes for the export's queries
+    sms_db_path = manifest.sms_db_path()
+    working_copy = choose_working_copy(args.working_copy, sms_db_path, args.working_copy_threshold, args.jobs)
+    working_directory = tempfile.mkdtemp(prefix='message_backup_') if working_copy == 'file' else None
+    try:
+        if working_copy == 'off':
+            conn = connect_read_only(sms_db_path)
+        else:
+            with progress.stage('working_copy'):
+                conn, sms_db_path = prepare_working_database(sms_db_path, working_directory)
+        try:
+            db_cursor = conn.cursor()
+
+            # Everything up to the newest message in the database will be covered once this export completes
+            db_cursor.execute('SELECT max(ROWID) FROM message;')
+            state.ceiling = db_cursor.fetchone()[0] or 0
+
+            # Work out up front which attachments are missing from the backup and how much there is to copy
+            if manifest.indexed:
+                with progress.stage('attachment_plan'):
+                    print_attachment_plan(db_cursor, manifest, state.floor)
+
+            # Look up the group chat titles up front so the main query is the only pass over the messages
+            group_titles = get_group_titles(db_cursor)
+
+            # Attachments are copied on background threads while the html is being written (into the shared store, if there is one, which they are linked to)
+            store = AttachmentStore(args.attachment_store) if args.attachment_store is not None else None
+            if budget is None and args.io_budget:
+                budget = IOBudget(args.io_budget * 1024 * 1024)
+            copier = AttachmentCopier(destination_path + '/attachments', workers=args.copy_workers, link_mode=args.link_mode, thumbnails=not args.no_thumbnails, store=store, budget=budget)
+            progress.copier = copier
 
-    # Get list of all unique phone numbers/iMessage accounts sent/received messages to/from
-    unique_number_query = 'SELECT DISTINCT id FROM handle;'
-    db_cursor.execute(unique_number_query)
-    all_numbers = db_cursor.fetchall()
-    num_of_numbers = len(all_numbers)
+            # Clear away temporary files left behind by copies which were cut off when the previous export stopped, then retry those copies
+            if args.incremental:
+                copier.remove_partial_files()
+            for destination_filename, (attachment_filename, mime_type) in state.pending_attachments.items():
+                copier.submit(attachment_filename, destination_filename, mime_type=mime_type)
 
-    # Get list of all unique group chats
-    unique_roomnames_query = 'SELECT DISTINCT cache_roomnames FROM message;'
-    db_cursor.execute(unique_roomnames_query)
-    all_rooms = db_cursor.fetchall()
-    num_of_rooms = len(all_rooms)
+            # Initialize progress bar. Progress is counted in messages, so big conversations don't throw the ETA off
+            progress.begin(count_messages(db_cursor, state.floor, state.ceiling))
 
-    # Initialize progress bar
-    total_tasks = num_of_numbers + num_of_rooms
-    status_index = 0
-    printProgressBar(status_index, total_tasks, prefix = 'Progress:', suffix = 'Complete', length = 50)
+            # Stream every conversation out of the database in a single ordered pass (split between several processes if asked to)
+            try:
+                if args.jobs > 1:
+                    export_conversations_in_parallel(db_cursor, sms_db_path, manifest, destination_path, copier, state, progress, group_titles, args.format, args.page_size, args.jobs, args.profile)
+                else:
+                    export_conversations(db_cursor, manifest, destination_path, copier, state, progress, group_titles, args.format, args.page_size)
+                progress.finish()
 
-    # First print an html document for each unique phone number
-    status_index = create_single_conversation_documents(all_numbers, db_cursor, destination_path, backup_path, status_index, total_tasks)
+                # Every message up to the ceiling has now been written
+                state.floor = state.ceiling
 
-    # Next, print an html document for each unique group chat
-    create_group_conversation_documents(all_rooms, db_cursor, destination_path, backup_path, status_index, total_tasks)
+                # Conversations without new messages which haven't been written in one of the formats yet are written from the message store
+                with progress.stage('missing_formats'):
+                    render_conversations(state, destination_path, args.format, args.page_size, missing_only=True)
+                if 'search' in args.format:
+                    with progress.stage('search_page'):
+                        write_static_search_index(destination_path, state)
+            finally:
+                # Wait for the remaining attachment copies to land on disk, then record how far we got
+                with progress.stage('copy_wait'):
+                    copier.close()
+                state.save(copier)
+                if store is not None:
+                    store.close()
+        finally:
+            # Close sql connection
+            conn.close()
+    finally:
+        # Throw away the working copy (even if the export stopped before the messages, e.g. while the copy was being indexed)
+        if working_directory is not None:
+            shutil.rmtree(working_directory)
 
-    # Close sql connection
-    conn.close()
+    print()
+    progress.print_summary()
+    if args.metrics is not None:
+        save_metrics(args.metrics, progress.report(backup=backup_path, destination=destination_path, incremental=args.incremental, jobs=args.jobs, formats=args.format))
+    failed = progress.attachment_statistics().get('failed', 0)
+    if failed:
+        print('\nWarning: ' + str(failed) + ' attachments could not be copied.', file=sys.stderr)
     print('\nBackup Complete!\n')
 
 
-# Creates an html document with every text message and attachment for each conversation with a single contact
-## all_numbers: A list with each phone number (or apple id, etc.) the user had correspondence with
+# Adds the options for the output files, which the export and the render command share
+## parser: the argparse parser (or subparser) to add them to
+### returns: nothing
+def add_output_arguments(parser):
+    parser.add_argument("-f", "--format", help="Comma-separated list of the formats to write each conversation in: html, jsonl, csv and/or search (a search index, search.db and search.html). (Default: html,search)",
+                    type=parse_formats, default=['html', 'search'])
+    parser.add_argument("--page-size", help="Number of messages on each page of a conversation. Use 0 to put whole conversations on one page. (Default: 1000)",
+                    type=int, default=1000)
+
+
+# Checks the value of --format
+## value: comma-separated list of formats (e.g. 'html,csv')
+### returns: list of the formats, raises argparse.ArgumentTypeError for a format there is no renderer for
+def parse_formats(value):
+    formats = [output_format.strip().lower() for output_format in value.split(',') if output_format.strip()]
+    unknown = [output_format for output_format in formats if output_format not in RENDERERS]
+    if unknown or not formats:
+        raise argparse.ArgumentTypeError('unknown format ' + repr(','.join(unknown) or value) + ' (choose from ' + ', '.join(RENDERERS) + ')')
+    # Drop duplicates but keep the order
+    return list(dict.fromkeys(formats))
+
+
+# Every message that belongs in an html document. Only messages with a ROWID in (floor, ceiling] are selected so incremental exports
+# skip everything that was already written. The first half of the union selects messages with a single contact (keyed by the contact's
+# phone number/apple id), the second half selects group chat messages (keyed by the cached roomname). The {selected}, {single_conversations}
+# and {group_conversations} placeholders can narrow the query down to the conversations in temp.selected_conversations.
+# Only the columns the export uses are selected (no attachment blobs), and the date of each message is formatted by SQLite:
+## date_string: the date of the message in local time. (apple's iOS backup calculates date from 1/1/2001 whereas unix is 1970, therefore we add
+##              978307200 to compensate for this difference. It is also calculated down to the 1/1000000000 of a second... so we convert it to seconds)
+## SQL Response column order -> [0,is_group][1,conversation][2,message_id][3,id][4,text][5,service][6,is_from_me][7,date][8,date_string][9,filename][10,mime_type]
+MESSAGE_ROWS_QUERY = """
+    SELECT 0 AS is_group, handle.id AS conversation, message.ROWID AS message_id, handle.id AS id, message.text AS text, message.service AS service,
+           message.is_from_me AS is_from_me, message.date AS date, strftime('%m/%d/%Y %H:%M:%S', message.date / 1000000000 + 978307200, 'unixepoch', 'localtime') AS date_string,
+           attachment.filename AS filename, attachment.mime_type AS mime_type
+    FROM {selected}handle
+    INNER JOIN message ON message.handle_id = handle.ROWID
+    INNER JOIN chat_message_join ON chat_message_join.message_id = message.ROWID
+    INNER JOIN chat ON chat_message_join.chat_id = chat.ROWID
+    LEFT JOIN message_attachment_join ON message_attachment_join.message_id = message.ROWID
+    LEFT JOIN attachment ON message_attachment_join.attachment_id = attachment.ROWID
+    WHERE chat.room_name IS NULL AND message.ROWID > :floor AND message.ROWID <= :ceiling {single_conversations}
+    UNION ALL
+    SELECT 1 AS is_group, message.cache_roomnames AS conversation, message.ROWID AS message_id, handle.id AS id, message.text AS text, message.service AS service,
+           message.is_from_me AS is_from_me, message.date AS date, strftime('%m/%d/%Y %H:%M:%S', message.date / 1000000000 + 978307200, 'unixepoch', 'localtime') AS date_string,
+           attachment.filename AS filename, attachment.mime_type AS mime_type
+    FROM {selected}message
+    LEFT JOIN handle ON message.handle_id = handle.ROWID
+    INNER JOIN chat_message_join ON chat_message_join.message_id = message.ROWID
+    INNER JOIN chat ON chat_message_join.chat_id = chat.ROWID
+    LEFT JOIN message_attachment_join ON message_attachment_join.message_id = message.ROWID
+    LEFT JOIN attachment ON message_attachment_join.attachment_id = attachment.ROWID
+    WHERE message.cache_roomnames IS NOT NULL AND message.ROWID > :floor AND message.ROWID <= :ceiling {group_conversations}
+"""
+
+# Every message in one ordered query. Ordering by conversation keeps each conversation's rows contiguous so they can be streamed
+# straight into its document without holding them in memory.
+ALL_MESSAGES_QUERY = MESSAGE_ROWS_QUERY.format(selected='', single_conversations='', group_conversations='') + ' ORDER BY is_group, conversation, date, message_id;'
+
+# Same as ALL_MESSAGES_QUERY, but only for the conversations in temp.selected_conversations (see select_conversations). The query starts from
+# the selected conversations (CROSS JOIN keeps SQLite from reordering that), and looks their messages up by handle or roomname, so a worker
+# process only reads its own share of the messages
+SELECTED_MESSAGES_QUERY = MESSAGE_ROWS_QUERY.format(
+    selected='temp.selected_conversations AS selected CROSS JOIN ',
+    single_conversations='AND selected.is_group = 0 AND handle.id = selected.conversation',
+    group_conversations='AND selected.is_group = 1 AND message.cache_roomnames = selected.conversation') + ' ORDER BY is_group, conversation, date, message_id;'
+
+# Number of rows each conversation has in ALL_MESSAGES_QUERY, used to share the conversations out evenly between processes
+CONVERSATION_SIZES_QUERY = 'SELECT is_group, conversation, COUNT(*) FROM (' + MESSAGE_ROWS_QUERY.format(selected='', single_conversations='', group_conversations='') + ') GROUP BY is_group, conversation;'
+
+
+# Extracts every conversation (single contacts first, then group chats) from one pass over the database into the message store, and writes
+# it in each of the output formats as it goes
+## db_cursor: SQL cursor for the backup database
+## manifest: BackupManifest used to locate the attachments in the backup
+## destination_path: The path specified where the files will be output to
+## copier: AttachmentCopier which copies attachments to the destination
+## state: ExportState (or WorkerChannel) holding the high-water marks of previous exports, updated as each conversation is written
+## progress: ExportProgress (or WorkerChannel) which is advanced after each conversation and times the stages of the export
+## group_titles: dictionary of cache_roomnames -> latest group title (see get_group_titles)
+## formats: list of output formats (see RENDERERS)
+## page_size: maximum number of messages on each page (0 for no limit)
+## selected: True to only export the conversations in temp.selected_conversations (see select_conversations)
+### returns: nothing
+def export_conversations(db_cursor, manifest, destination_path, copier, state, progress, group_titles, formats, page_size, selected=False):
+    # Fetch the rows a batch at a time rather than calling fetchall() so only a few rows are ever held in memory
+    with progress.stage('query'):
+        db_cursor.execute(SELECTED_MESSAGES_QUERY if selected else ALL_MESSAGES_QUERY, {'floor': state.floor, 'ceiling': state.ceiling})
+    for (is_group, conversation), rows in itertools.groupby(fetch_rows(db_cursor, progress), key=lambda row: (row[0], row[1])):
+        if is_group:
+            # Users can change the name of the groupchat (or not set one at all...). Name the files after the latest title + the cached roomname (to avoid name collisions)
+            room_name = group_titles.get(conversation, 'untitled')
+            name = room_name + '_' + conversation
+            title = room_name + ' Group Chat'
+        else:
+            name = conversation
+            title = 'Conversations with ' + conversation
+
+        key = conversation_key(is_group, conversation)
+        previous = state.conversations.get(key)
+        if previous is not None:
+            # This conversation was (at least partially) exported before. Skip the messages it already has and keep adding to the same files
+            rows = (row for row in rows if row[2] > previous['message_id'])
+            name = previous['name']
+        conversation_info = {'name': name, 'title': title, 'group': bool(is_group)}
+        entry = write_conversation(extract_messages(rows, manifest, copier, destination_path), destination_path, conversation_info, formats, page_size, previous, progress)
+
+        # Record the high-water mark of this conversation (if anything was written)
+        if entry is not None:
+            state.record(key, entry, copier)
+
+        # Update Progress Bar
+        progress.advance()
+
+
+# Iterates the rows of a query, timing how long SQLite takes to produce them as the query stage. The rows are fetched in batches, so the clock
+# is only read once per batch
+## db_cursor: SQL cursor on which the query was executed
+## progress: ExportProgress (or WorkerChannel) to add the time to
+## batch_size: number of rows fetched at a time
+### returns: generator of rows
+def fetch_rows(db_cursor, progress, batch_size=1000):
+    while True:
+        start = time.perf_counter()
+        rows = db_cursor.fetchmany(batch_size)
+        progress.add_time('query', time.perf_counter() - start)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+
+# Shares the conversations out between several processes, each of which runs export_conversations over its own read-only connection.
+# Progress and checkpoints from the processes are merged into the progress bar and state of this process
 ## db_cursor: SQL cursor for the backup database
+## sms_db_path: path of the database the worker processes read (sms.db in the backup, or its working copy)
+## manifest: BackupManifest used to locate the attachments in the backup
 ## destination_path: The path specified where the files will be output to
-## backup_path: the path to the iTunes iOS backup file specified to pull information from
-## status_index: An integer index variable which keeps track of progress in the progess bar
-## total_tasks: An integer holding the number of total conversation documents (including group chats). Considered '100%' for progress bar
-### returns: The updated status_index so we can pass it along to the create_group method and have accurate status updates
-def create_single_conversation_documents(all_numbers, db_cursor, destination_path, backup_path, status_index, total_tasks):
-    for number in enumerate(all_numbers):
-        # Ensure the phone number is ascii compatible
-        number = number[1][0].encode('ascii')
-
-        # Get list of all messages for specified phone number from SQL db
-        sql_query = 'SELECT * FROM (SELECT * FROM (SELECT mess_hand_chat_join.mess_ROWID as message_id, mess_hand_chat_join.id as id, mess_hand_chat_join.text as text, mess_hand_chat_join.service as service, mess_hand_chat_join.is_from_me as is_from_me, mess_hand_chat_join.date as \'date\', mess_hand_chat_join.date_read as date_read, mess_hand_chat_join.date_delivered as date_delivered, chat.ROWID as chat_id, chat.room_name as room_name FROM (SELECT * FROM (SELECT message.ROWID as mess_ROWID, handle.id as id, message.text as text, message.service as service, message.is_from_me as is_from_me, message.date as \'date\',  message.date_read as date_read, message.date_delivered as date_delivered FROM handle INNER JOIN message ON message.handle_id = handle.ROWID) as message_info INNER JOIN chat_message_join on message_info.mess_ROWID = chat_message_join.message_id) as mess_hand_chat_join INNER JOIN chat on mess_hand_chat_join.chat_id = chat.ROWID) as message_chat_info LEFT JOIN message_attachment_join on message_chat_info.message_id = message_attachment_join.message_id) as message_chat_att_join LEFT JOIN attachment on message_chat_att_join.attachment_id = attachment.ROWID WHERE id = \'' + number + '\' ORDER BY message_chat_att_join.date ASC;'
-        db_cursor.execute(sql_query)
-        all_rows = db_cursor.fetchall()
-
-        # Create new html file
-        new_html_filename = destination_path + '/' + number + '.html'
-        new_file = open(new_html_filename, "w")
-        lines_written = 0
+## copier: AttachmentCopier of this process (its settings are used by the worker processes, which copy their own attachments)
+## state: ExportState holding the high-water marks of previous exports
+## progress: ExportProgress shown to the user
+## group_titles: dictionary of cache_roomnames -> latest group title (see get_group_titles)
+## formats: list of output formats (see RENDERERS)
+## page_size: maximum number of messages on each page (0 for no limit)
+## jobs: number of worker processes
+## profile: --profile file. Each worker saves its own profile next to it (None not to profile the workers)
+### returns: nothing, raises RuntimeError if a worker process fails
+def export_conversations_in_parallel(db_cursor, sms_db_path, manifest, destination_path, copier, state, progress, group_titles, formats, page_size, jobs, profile=None):
+    db_cursor.execute(CONVERSATION_SIZES_QUERY, {'floor': state.floor, 'ceiling': state.ceiling})
+    shares = split_conversations(db_cursor, jobs)
+
+    # Spawn rather than fork, so the workers don't inherit this process's copier threads (and behave the same on macOS and Linux)
+    context = multiprocessing.get_context('spawn')
+    messages = context.Queue()
+    workers = []
+    for index, conversations in enumerate(shares):
+        keys = [conversation_key(is_group, conversation) for is_group, conversation in conversations]
+        previous = {key: state.conversations[key] for key in keys if key in state.conversations}
+        titles = {conversation: group_titles[conversation] for is_group, conversation in conversations if is_group and conversation in group_titles}
+        worker_profile = None if profile is None else profile + '.worker' + str(index)
+        # The workers share the I/O budget
+        store_path = copier.store.path if copier.store is not None else None
+        worker = context.Process(target=export_worker, args=(index, messages, sms_db_path, manifest, destination_path, copier.workers, copier.link_mode, copier.thumbnails, store_path, copier.budget, formats, page_size, state.floor, state.ceiling, conversations, previous, titles, worker_profile))
+        worker.start()
+        workers.append(worker)
+
+    running = set(range(len(workers)))
+    errors = []
+    try:
+        while running:
+            try:
+                message = messages.get(timeout=1)
+            except queue.Empty:
+                # A worker which died without reporting back (e.g. killed by the OS) would otherwise be waited on forever.
+                # Anything it managed to send has been flushed by the time it exits, so it is only given up on once the queue is empty
+                for index in [index for index in running if not workers[index].is_alive()]:
+                    running.discard(index)
+                    errors.append('Worker ' + str(index) + ' exited with code ' + str(workers[index].exitcode))
+                continue
+
+            if message[0] == 'progress':
+                progress.merge(message[1], message[2])
+            elif message[0] == 'checkpoint':
+                state.merge(message[1], message[2], message[3])
+                state.checkpoint(copier)
+            elif message[0] == 'done':
+                running.discard(message[1])
+            elif message[0] == 'error':
+                running.discard(message[1])
+                errors.append(message[2])
+    finally:
+        for worker in workers:
+            if errors or running:
+                worker.terminate()
+            worker.join()
+
+    if errors:
+        raise RuntimeError('Export worker failed:\n' + errors[0])
+
+
+# Entry point of a worker process started by export_conversations_in_parallel. Reports back through the messages queue:
+# ('progress', index, measurements), ('checkpoint', index, conversations, pending attachments), then ('done', index) or ('error', index, traceback)
+## index: number of this worker
+## messages: multiprocessing queue back to the parent process
+## sms_db_path: path of the database to read (sms.db in the backup, or its working copy)
+## manifest: BackupManifest used to locate the attachments in the backup
+## destination_path: The path specified where the files will be output to
+## copy_workers: number of attachment copy threads in this process
+## link_mode: 'copy', 'hardlink' or 'reflink' (see AttachmentCopier)
+## thumbnails: whether to make thumbnails of images and videos (see AttachmentCopier)
+## store_path: folder of the AttachmentStore to put the attachments in (None to copy them straight to the destination)
+## budget: IOBudget the worker's copies share with the rest of the export (None for no limit)
+## formats: list of output formats (see RENDERERS)
+## page_size: maximum number of messages on each page (0 for no limit)
+## floor, ceiling: range of message ROWIDs to export (see ExportState)
+## conversations: list of (is_group, conversation) this worker exports
+## previous: the high-water marks of previous exports for these conversations
+## group_titles: dictionary of cache_roomnames -> latest group title for these conversations
+## profile: file to save a cProfile profile of this worker to (None not to profile it)
+### returns: nothing
+def export_worker(index, messages, sms_db_path, manifest, destination_path, copy_workers, link_mode, thumbnails, store_path, budget, formats, page_size, floor, ceiling, conversations, previous, group_titles, profile=None):
+    profiler = None
+    if profile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        conn = connect_read_only(sms_db_path)
+        db_cursor = conn.cursor()
+        select_conversations(db_cursor, conversations)
+
+        store = AttachmentStore(store_path) if store_path is not None else None
+        copier = AttachmentCopier(destination_path + '/attachments', workers=copy_workers, link_mode=link_mode, thumbnails=thumbnails, store=store, budget=budget)
+        channel = WorkerChannel(messages, index, floor, ceiling, previous, copier)
+        try:
+            export_conversations(db_cursor, manifest, destination_path, copier, channel, channel, group_titles, formats, page_size, selected=True)
+        finally:
+            with channel.stage('copy_wait'):
+                copier.close()
+            channel.send_checkpoint(copier)
+            channel.send_progress()
+        conn.close()
+        if store is not None:
+            store.close()
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        messages.put(('done', index))
+    except Exception:
+        messages.put(('error', index, traceback.format_exc()))
+
+
+# Stands in for ExportState and ExportProgress inside a worker process, passing everything on to the parent process
+class WorkerChannel(object):
+    ## messages: multiprocessing queue back to the parent process
+    ## index: number of this worker
+    ## floor, ceiling: range of message ROWIDs to export (see ExportState)
+    ## conversations: the high-water marks of previous exports for this worker's conversations
+    ## copier: AttachmentCopier of this worker, whose statistics are sent along with the progress
+    def __init__(self, messages, index, floor, ceiling, conversations, copier):
+        self.messages = messages
+        self.index = index
+        self.floor = floor
+        self.ceiling = ceiling
+        self.conversations = conversations
+        self.copier = copier
+        # High-water marks recorded since the last checkpoint was sent
+        self.recorded = {}
+        self.last_sent = time.time()
+        # Progress and stage times measured since the last update was sent (see send_progress)
+        self.progress = ExportProgress()
+        self.timed_seconds = 0.0
+        self.progress_sent = time.time()
+        self.next_check = 0
+
+    def record(self, key, entry, copier):
+        self.conversations[key] = entry
+        self.recorded[key] = entry
+        if time.time() - self.last_sent >= 2.0:
+            self.send_checkpoint(copier)
+
+    # The snapshot of unfinished copies is taken after the conversations were written, so every attachment they refer to is either on disk or in it
+    def send_checkpoint(self, copier):
+        self.messages.put(('checkpoint', self.index, self.recorded, copier.pending_copies()))
+        self.recorded = {}
+        self.last_sent = time.time()
+
+    def advance(self, count=1):
+        self.progress.conversations += count
+        self.send_progress(interval=0.25)
+
+    def add_messages(self, count=1):
+        self.progress.messages += count
+        if self.progress.messages >= self.next_check:
+            self.next_check = self.progress.messages + 250
+            self.send_progress(interval=0.25)
+
+    def add_time(self, stage, seconds):
+        self.progress.add_time(stage, seconds)
+        self.timed_seconds += seconds
+
+    # Times a stage through add_time, just like ExportProgress does
+    def stage(self, name):
+        return ExportProgress.stage(self, name)
+
+    def record_conversation(self, name, messages, seconds):
+        self.progress.record_conversation(name, messages, seconds)
+
+    # Send the parent process what was measured since the last update (see ExportProgress.merge)
+    ## interval: only send it if the last update is at least this many seconds old
+    def send_progress(self, interval=0):
+        if time.time() - self.progress_sent < interval:
+            return
+        self.messages.put(('progress', self.index, {'conversations': self.progress.conversations, 'messages': self.progress.messages, 'stages': self.progress.stages,
+                                                     'slowest': self.progress.slowest, 'copy': self.copier.statistics()}))
+        self.progress = ExportProgress()
+        self.next_check = 0
+        self.progress_sent = time.time()
+
+
+# Shares conversations out between processes so each gets roughly the same number of rows (biggest conversations first, each to the least busy process)
+## conversation_sizes: iterable of (is_group, conversation, number of rows)
+## jobs: number of processes
+### returns: list of lists of (is_group, conversation), one list per process that has anything to do
+def split_conversations(conversation_sizes, jobs):
+    shares = [(0, index, []) for index in range(jobs)]
+    for is_group, conversation, size in sorted(conversation_sizes, key=lambda conversation_size: -conversation_size[2]):
+        rows, index, conversations = heapq.heappop(shares)
+        conversations.append((is_group, conversation))
+        heapq.heappush(shares, (rows + size, index, conversations))
+    return [conversations for rows, index, conversations in sorted(shares, key=lambda share: share[1]) if conversations]
+
+
+# Fills temp.selected_conversations, which narrows SELECTED_MESSAGES_QUERY down to a set of conversations
+## db_cursor: SQL cursor for the backup database
+## conversations: list of (is_group, conversation)
+### returns: nothing
+def select_conversations(db_cursor, conversations):
+    db_cursor.execute('CREATE TEMP TABLE selected_conversations (is_group INTEGER, conversation TEXT, PRIMARY KEY (is_group, conversation));')
+    db_cursor.executemany('INSERT INTO temp.selected_conversations VALUES (?, ?);', conversations)
+
+
+# Key of a conversation in ExportState
+def conversation_key(is_group, conversation):
+    return str(is_group) + ':' + conversation
+
+
+# Indexes for the export's queries which sms.db doesn't have:
+## export_message_handle, export_message_roomnames: the messages of a conversation (worker processes, see SELECTED_MESSAGES_QUERY), and the
+##                                                 latest title of each group chat (get_group_titles). SQLite ends every index with the ROWID,
+##                                                 so incremental exports only look at the conversation's messages after the last export
+## export_chat_message_join: the chat of each message, for the messages looked up by conversation
+## export_message_attachment_join: the attachments of each message, and of the messages after a ROWID (incremental exports)
+EXPORT_INDEXES = """
+    CREATE INDEX IF NOT EXISTS export_message_handle ON message (handle_id);
+    CREATE INDEX IF NOT EXISTS export_message_roomnames ON message (cache_roomnames);
+    CREATE INDEX IF NOT EXISTS export_chat_message_join ON chat_message_join (message_id, chat_id);
+    CREATE INDEX IF NOT EXISTS export_message_attachment_join ON message_attachment_join (message_id, attachment_id);
+    ANALYZE;
+"""
+
+
+# Decide whether to export from a working copy of sms.db
+## working_copy: 'auto', 'memory', 'file' or 'off' (from --working-copy)
+## sms_db_path: path of sms.db in the backup
+## threshold: size in MB above which 'auto' makes a working copy
+## jobs: number of processes exporting
+### returns: 'memory', 'file' or 'off'
+def choose_working_copy(working_copy, sms_db_path, threshold, jobs):
+    if working_copy == 'auto':
+        working_copy = 'file' if os.path.getsize(sms_db_path) > threshold * 1024 * 1024 else 'off'
+    if working_copy == 'memory' and jobs > 1:
+        # Worker processes can't see an in-memory database, they need a file to open
+        working_copy = 'file'
+    return working_copy
+
+
+# Copies sms.db out of the backup with SQLite's backup API and adds EXPORT_INDEXES to the copy. Prints how long this took
+## sms_db_path: path of sms.db in the backup
+## working_directory: directory to put the working copy in, or None to keep it in memory
+### returns: (connection to the working copy, path of the working copy or None if it is in memory)
+def prepare_working_database(sms_db_path, working_directory=None):
+    start_time = time.time()
+    working_filename = None if working_directory is None else working_directory + '/sms.db'
+    source = connect_read_only(sms_db_path)
+    conn = sqlite3.connect(working_filename or ':memory:')
+    source.backup(conn)
+    source.close()
+    copy_time = time.time() - start_time
+    conn.executescript(EXPORT_INDEXES)
+    print('Prepared a working copy of sms.db (' + format_size(os.path.getsize(sms_db_path)) + (' in memory' if working_filename is None else '') + '): copied in %.1fs, indexed in %.1fs' % (copy_time, time.time() - start_time - copy_time))
+    return conn, working_filename
+
+
+# Opens a read-only connection to a database in the backup. immutable=1 tells SQLite that nothing else will change the file,
+# so it skips locking altogether (which also lets several processes read it at the same time)
+## filename: path of the database file
+### returns: sqlite3 connection
+def connect_read_only(filename):
+    return sqlite3.connect('file:' + urllib.parse.quote(os.path.abspath(filename)) + '?mode=ro&immutable=1', uri=True)
+
+
+# Writes a single conversation to the message store and in each of the output formats, or appends to the files written by a previous export
+## records: iterable of message records (see extract_messages) belonging to this conversation, in date order
+## destination_path: The path specified where the files will be output to
+## conversation: {name, title, group} of the conversation. Its files are named after name (e.g. +11234567890.html)
+## formats: list of output formats (see RENDERERS)
+## page_size: maximum number of messages on each html page (0 for no limit)
+## previous: the conversation's entry in ExportState if a previous export wrote it, None if the conversation is new
+## progress: ExportProgress (or WorkerChannel) which times the writing, None not to
+### returns: the conversation's new entry for ExportState, or None if there were no messages (in which case no file is touched)
+def write_conversation(records, destination_path, conversation, formats, page_size=1000, previous=None, progress=None):
+    start = time.perf_counter()
+    timed_before = progress.timed_seconds if progress is not None else 0
+    records = iter(records)
+    record = next(records, None)
+    if progress is not None:
+        progress.add_time('extract', time.perf_counter() - start - (progress.timed_seconds - timed_before))
+    if record is None:
+        return None
+
+    outputs = previous['outputs'] if previous is not None else {}
+    writers = {'store': MessageStoreFile(destination_path, conversation, outputs.get('store'))}
+    # Formats the previous export didn't write can't be appended to. They are written from the whole store afterwards (see render_conversations)
+    for output_format in formats:
+        if previous is None or output_format in outputs:
+            writers[output_format] = RENDERERS[output_format](destination_path, conversation, outputs.get(output_format), page_size)
+    record, count, highest_id, written = write_records(itertools.chain([record], records), writers, progress, 'extract')
+
+    # ROWIDs don't follow the date order (messages synced from iCloud later get new ROWIDs), so the high-water mark is the highest ROWID
+    # written rather than the ROWID of the last message
+    message_id = max(highest_id, previous['message_id']) if previous is not None else highest_id
+    entry = dict(conversation, message_id=message_id, date=record['date'], messages=(previous or {}).get('messages', 0) + count, outputs=written)
+    if progress is not None:
+        progress.record_conversation(conversation['name'], count, time.perf_counter() - start)
+    return entry
+
+
+# Gives each record to every writer (the message store and the renderers) and closes them
+## records: iterable of message records
+## writers: output format (or 'store') -> object with write(record) and close() (see RENDERERS)
+## progress: ExportProgress (or WorkerChannel) which times each writer as a stage (render_<format>, or store), None not to
+## source_stage: the stage the time spent waiting for the records counts towards (e.g. extract), less any stages timed while producing them
+### returns: (last record, number of records, highest message id, output format (or 'store') -> what its close() returned)
+def write_records(records, writers, progress=None, source_stage=None):
+    try:
+        count = 0
+        record = None
+        highest_id = None
+        if progress is None:
+            for record in records:
+                count += 1
+                if highest_id is None or record['id'] > highest_id:
+                    highest_id = record['id']
+                for writer in writers.values():
+                    writer.write(record)
+            return record, count, highest_id, {output_format: writer.close() for output_format, writer in writers.items()}
+
+        stage_names = {output_format: output_format if output_format == 'store' else 'render_' + output_format for output_format in writers}
+        seconds = dict.fromkeys(writers, 0.0)
+        start = time.perf_counter()
+        timed_before = progress.timed_seconds
+        for record in records:
+            count += 1
+            if highest_id is None or record['id'] > highest_id:
+                highest_id = record['id']
+            before = time.perf_counter()
+            for output_format, writer in writers.items():
+                writer.write(record)
+                after = time.perf_counter()
+                seconds[output_format] += after - before
+                before = after
+            progress.add_messages()
+
+        closed = {}
+        for output_format, writer in writers.items():
+            before = time.perf_counter()
+            closed[output_format] = writer.close()
+            seconds[output_format] += time.perf_counter() - before
+        # Whatever isn't spent in the writers (or in stages timed meanwhile, e.g. the query) went into producing the records
+        waited = time.perf_counter() - start - sum(seconds.values()) - (progress.timed_seconds - timed_before)
+        for output_format, writer_seconds in seconds.items():
+            progress.add_time(stage_names[output_format], writer_seconds)
+        progress.add_time(source_stage, waited)
+        return record, count, highest_id, closed
+    except BaseException:
+        # Writers holding on to something more than an open file (e.g. a database connection) let go of it before the error carries on
+        for writer in writers.values():
+            if hasattr(writer, 'abort'):
+                writer.abort()
+        raise
+
+
+# Turns rows from ALL_MESSAGES_QUERY into one record per message. The message's attachments are located in the backup and queued to be copied
+## rows: iterable of rows belonging to one conversation, in date order
+## manifest: BackupManifest used to locate the attachments in the backup
+## copier: AttachmentCopier which copies attachments to the destination
+## destination_path: The path specified where the files will be output to
+### returns: generator of {id, sender, text, service, from_me, date, date_string, attachments}, where sender is the phone number/apple id
+###          of the message's contact (None for messages the user sent to a group chat), date is apple's timestamp of the message and
+###          attachments is a list of {source, mime_type, file, thumbnail} (see locate_attachment)
+def extract_messages(rows, manifest, copier, destination_path):
+    attachments_folder = os.path.relpath(copier.destination_path, destination_path).replace(os.sep, '/')
+
+    # A message gets a row for each of its attachments (and for each chat it is joined to), which are always next to each other
+    for message_id, message_rows in itertools.groupby(rows, key=lambda row: row[2]):
+        row = next(message_rows)
+        attachments = []
+        sources = set()
+        for attachment_row in itertools.chain([row], message_rows):
+            if attachment_row[9] is not None and attachment_row[9] not in sources:
+                sources.add(attachment_row[9])
+                attachments.append(locate_attachment(attachment_row[9], attachment_row[10], manifest, copier, attachments_folder))
+        yield {'id': message_id, 'sender': row[3], 'text': row[4], 'service': row[5], 'from_me': bool(row[6]), 'date': row[7], 'date_string': row[8], 'attachments': attachments}
+
+
+# Finds an attachment in the backup and queues it to be copied to the destination
+## filename: unhashed filename from iOS message backup sql db
+## mime_type: the mime_type of the attachment (e.g. image/gif, video/mp4, etc.)
+## manifest: BackupManifest used to locate the attachment in the backup
+## copier: AttachmentCopier which copies the attachment to the destination in the background
+## attachments_folder: path of the copier's folder relative to the destination
+### returns: {source, mime_type, file, thumbnail}, where source is filename, file is the path of the copy relative to the destination (None if
+###          the attachment isn't in the backup) and thumbnail is the path of its thumbnail relative to the destination (None if none is made)
+def locate_attachment(filename, mime_type, manifest, copier, attachments_folder):
+    attachment = {'source': filename, 'mime_type': mime_type, 'file': None, 'thumbnail': None}
+
+    # Find hashed file in the backup folder
+    backup_file = manifest.find_attachment(filename)
+    if backup_file is None:
+        # Something went wrong... likely the attachment was deleted
+        return attachment
+    hashed_filename, size = backup_file
+    ## Create the full destination filename with path for this attachment file
+    destination_filename = copier.destination_path + '/' + hashed_filename
+
+    # Add extension to video files by mime_type. This will allow them to play in browser. (Images seem to work without adding an extension)
+    if mime_type is not None and mime_type == 'video/mp4':
+        destination_filename = destination_filename + '.mp4'
+    elif mime_type is not None and mime_type == 'video/quicktime':
+        destination_filename = destination_filename + '.mov'
+
+    # Queue the attachment to be copied to the destination folder so we can still reference the file even if the original backup is deleted
+    copier.submit(manifest.file_path(hashed_filename), destination_filename, size, mime_type)
+    attachment['file'] = attachments_folder + '/' + os.path.basename(destination_filename)
+
+    thumbnail_filename = copier.thumbnail_filename(destination_filename, mime_type)
+    if thumbnail_filename is not None:
+        attachment['thumbnail'] = attachments_folder + '/' + THUMBNAILS_FOLDER + '/' + os.path.basename(thumbnail_filename)
+    return attachment
+
+
+# Folder in the destination which holds the message store: the records of each conversation (see extract_messages), one JSON object per line,
+# in a file per conversation which later exports append to. The output formats are written from it, so they can be written again without the backup
+STORE_FOLDER = 'store'
+
+# Encodes the records of the message store. The records are plain data, so there's no need to check them for reference cycles
+STORE_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), check_circular=False)
+
+
+# Path of a conversation's file in the message store
+## destination_path: The path specified where the files will be output to
+## conversation: {name, ...} of the conversation (see write_conversation)
+def message_store_filename(destination_path, conversation):
+    return destination_path + '/' + STORE_FOLDER + '/' + conversation['name'] + '.jsonl'
+
+
+# Reads a conversation's records back out of the message store
+## destination_path: The path specified where the files will be output to
+## conversation: the conversation's entry in ExportState
+### returns: generator of records, up to the end of the last export that wrote the conversation (anything after that was left by an interrupted export)
+def read_message_store(destination_path, conversation):
+    remaining = conversation['outputs']['store']['size']
+    with open(message_store_filename(destination_path, conversation), 'rb') as store_file:
+        for line in store_file:
+            remaining -= len(line)
+            if remaining < 0:
+                break
+            yield json.loads(line)
+
+
+# Writes conversations in the given formats from the message store, without reading the backup
+## state: ExportState listing the conversations. The new outputs of each conversation are recorded in it
+## destination_path: The path specified where the files will be output to
+## formats: list of output formats (see RENDERERS)
+## page_size: maximum number of messages on each html page (0 for no limit)
+## missing_only: True to only write the formats a conversation hasn't been written in yet (e.g. by an export with another --format)
+## progress: ExportProgress which times the stages and is advanced after each conversation (None for neither)
+### returns: nothing
+def render_conversations(state, destination_path, formats, page_size, missing_only=False, progress=None):
+    for entry in state.conversations.values():
+        missing_formats = [output_format for output_format in formats if not missing_only or output_format not in entry['outputs']]
+        if missing_formats:
+            start = time.perf_counter()
+            renderers = {output_format: RENDERERS[output_format](destination_path, entry, None, page_size) for output_format in missing_formats}
+            record, count, highest_id, written = write_records(read_message_store(destination_path, entry), renderers, progress, 'read_store')
+            entry['outputs'].update(written)
+            if progress is not None:
+                progress.record_conversation(entry['name'], count, time.perf_counter() - start)
+        if progress is not None:
+            progress.advance()
+
+
+# The render command: writes the conversations of an existing archive again from its message store (e.g. after changing the styling, or in
+# another format), which takes a fraction of the time of exporting them from the backup
+## destination_path: the archive (the destination of a previous export)
+## formats: list of output formats (see RENDERERS)
+## page_size: maximum number of messages on each html page (0 for no limit)
+### returns: nothing
+def render_archive(destination_path, formats, page_size):
+    state_filename = destination_path + '/' + EXPORT_STATE_FILENAME
+    if not os.path.exists(state_filename):
+        print('Error: No archive found. ' + destination_path + ' has no ' + EXPORT_STATE_FILENAME + '.')
+        sys.exit()
+    state = ExportState(state_filename)
+
+    progress = ExportProgress()
+    progress.begin(sum(entry.get('messages', 0) for entry in state.conversations.values()))
+    render_conversations(state, destination_path, formats, page_size, progress=progress)
+    progress.finish()
+    state.save()
+    if 'search' in formats or 'html' in formats:
+        with progress.stage('search_page'):
+            write_static_search_index(destination_path, state)
+    print()
+    progress.print_summary()
+    print('\nRender Complete!\n')
+
+
+# Writes a conversation as html pages of at most page_size messages, so even years-long conversations open quickly in a browser.
+# The conversation's index page (e.g. +11234567890.html) links to every page, and the pages go in a folder next to it (+11234567890_pages/page_0001.html)
+## pages: [first date, last date, number of messages] of each page
+## content_size: size of the last page up to (but not including) its closing tags. The next export cuts the page off here to append to it
+class ConversationPages(object):
+    ## destination_path: The path specified where the files will be output to
+    ## conversation: {name, title, group} of the conversation (see write_conversation)
+    ## previous: {pages, size} from the previous export that wrote the conversation, None to write the pages from scratch
+    ## page_size: maximum number of messages on each page (0 for no limit)
+    def __init__(self, destination_path, conversation, previous=None, page_size=1000):
+        self.index_filename = destination_path + '/' + conversation['name'] + '.html'
+        self.pages_directory = destination_path + '/' + conversation['name'] + '_pages'
+        self.title = conversation['title']
+        self.group = conversation['group']
+        self.page_size = page_size
+        self.pages = []
+        self.content_size = 0
+        self.page_file = None
+
+        # Links to attachments are relative, so the archive still works when it is moved
+        self.root_url = urllib.parse.quote(os.path.relpath(destination_path, self.pages_directory).replace(os.sep, '/'))
+
+        if previous is not None and os.path.exists(self.page_filename(len(previous['pages']))):
+            # Cut off the end of the last page (along with anything an interrupted export appended after it) and carry on from there. The pages
+            # are a copy, so ExportState only changes once the conversation is finished and recorded (an interrupted export saves the old entry)
+            self.pages = [list(page) for page in previous['pages']]
+            os.truncate(self.page_filename(len(self.pages)), previous['size'])
+            self.page_file = open(self.page_filename(len(self.pages)), 'a', encoding='utf-8')
+        else:
+            # Pages written before (e.g. with another page size) would be left over after the last new page
+            shutil.rmtree(self.pages_directory, ignore_errors=True)
+            os.makedirs(self.pages_directory)
+
+    # Path of a page (numbered from 1)
+    def page_filename(self, number):
+        return self.pages_directory + '/' + self.page_name(number)
+
+    def page_name(self, number):
+        return 'page_%04d.html' % number
+
+    # Adds a message to the current page, starting a new page if it is full
+    def write(self, record):
+        if self.page_file is None or (self.page_size and self.pages[-1][2] >= self.page_size):
+            self.start_page()
+        add_row_to_table(self.page_file, self.root_url, record, group=self.group)
+        page = self.pages[-1]
+        if page[0] is None:
+            page[0] = record['date_string']
+        page[1] = record['date_string']
+        page[2] += 1
+
+    def start_page(self):
+        if self.page_file is not None:
+            self.end_page(last=False)
+        self.pages.append([None, None, 0])
+        self.page_file = open(self.page_filename(len(self.pages)), 'w', encoding='utf-8')
 
         # Write out html header with CSS styling
-        write_html_header(new_file)
+        write_html_header(self.page_file)
 
-        new_file.write('<h1>Conversations with ' + number + '</h1>')
+        self.page_file.write('<h1>' + self.title + '</h1>')
+        self.page_file.write(self.navigation(len(self.pages), last=True))
 
         # Write table header row
-        new_file.write('<table>')
-
-        # For each message create a row in the table with the message information
-        for row in all_rows:
-            # SQL Response column order -> [0,message_id][1,id][2,text][3,service][4,is_from_me][5,date][6,date_read][7,date_delivered][8,chat_id][9,room_name][10,message_id:1][11,attachment_id][12,ROWID][13,guid][14,created_date][15,start_date][16,filename][17,uti][18,mime_type][19,transfer_state][20,is_outgoing][21,user_info][22,transfer_name][23,total_bytes][24,is_sticker][25,sticker_user_info][26,attribution_info][27,hide_attachment][28,ck_sync_state][29,ck_server_change_token_blob][30,ck_record_id][31,original_guid]
-            phone_num = row[1]
-            message = row[2]
-            service = row[3]
-            is_from_me = row[4]
-            date_timestamp = row[5]
-            room_name = row[9]
-            attachment_filename = row[16]
-            mime_type = row[18]
-
-            # If the message is from a group chat, don't add it now, we'll record that in a separate file
-            if room_name is None:
-                lines_written += 1
-                # Print out the message as a row in the table
-                add_row_to_table(new_file, backup_path, destination_path, phone_num, message, service, is_from_me, date_timestamp, attachment_filename, mime_type)
-
-        # End html file
-        new_file.write('</body></html>')
-
-        # If no lines written in the file (due to no messages sent/recieved with that phone number), just delete the created file
-        if lines_written < 1:
-            os.remove(new_html_filename)
+        self.page_file.write('<table>')
 
-        # Update Progress Bar
-        status_index += 1
-        printProgressBar(status_index, total_tasks, prefix = 'Progress:', suffix = 'Complete', length = 50)
-    return status_index
+    # Closes off the current page. Whether it links to a next page is only known once the next message turns up, so the links are written last
+    def end_page(self, last):
+        self.page_file.flush()
+        self.content_size = os.fstat(self.page_file.fileno()).st_size
+        self.page_file.write('</table>' + self.navigation(len(self.pages), last) + HTML_FOOTER)
+        self.page_file.close()
+        self.page_file = None
 
-# Creates an html document with every text message and attachment for each group chat
-## all_rooms: A list with each group chat the user was a part of
-## db_cursor: SQL cursor for the backup database
+    # Links to the index page and the previous and next pages
+    def navigation(self, number, last):
+        links = ['<a href="../' + urllib.parse.quote(os.path.basename(self.index_filename)) + '">All pages</a>']
+        if number > 1:
+            links.append('<a href="' + self.page_name(number - 1) + '">&larr; Previous</a>')
+        links.append('Page ' + str(number))
+        if not last:
+            links.append('<a href="' + self.page_name(number + 1) + '">Next &rarr;</a>')
+        return '<p>' + ' | '.join(links) + '</p>'
+
+    # Finish the last page and (re)write the index page
+    ### returns: {pages, size} for ExportState
+    def close(self):
+        self.end_page(last=True)
+        pages_url = urllib.parse.quote(os.path.basename(self.pages_directory))
+        with open(self.index_filename, 'w', encoding='utf-8') as index_file:
+            write_html_header(index_file)
+            index_file.write('<h1>' + self.title + '</h1><table>')
+            for number, (first_date, last_date, count) in enumerate(self.pages, 1):
+                index_file.write('<tr><td><a href="' + pages_url + '/' + self.page_name(number) + '">Page ' + str(number) + '</a></td><td>' + str(first_date) + ' - ' + str(last_date) + '</td><td>' + str(count) + ' messages</td></tr>')
+            index_file.write('</table>' + HTML_FOOTER)
+        return {'pages': self.pages, 'size': self.content_size}
+
+
+# Writes a conversation to a single file, which later exports append to
+class ConversationFile(object):
+    ## filename: path of the file
+    ## previous: {size} from the previous export that wrote the file, None to start the file from scratch
+    def __init__(self, filename, previous):
+        self.filename = filename
+        if previous is not None and os.path.exists(filename):
+            # Cut off anything an interrupted export appended after the end of the previous export and carry on from there
+            os.truncate(filename, previous['size'])
+            self.file = open(filename, 'a', encoding='utf-8', newline='')
+        else:
+            self.file = open(filename, 'w', encoding='utf-8', newline='')
+            self.start()
+
+    # Writes whatever goes at the top of a new file
+    def start(self):
+        pass
+
+    ### returns: {size} of the finished file, for ExportState
+    def close(self):
+        self.file.close()
+        return {'size': os.path.getsize(self.filename)}
+
+
+# Appends the records of a conversation to its file in the message store (see STORE_FOLDER)
+class MessageStoreFile(ConversationFile):
+    ## destination_path: The path specified where the files will be output to
+    ## conversation: {name, ...} of the conversation (see write_conversation)
+    ## previous: {size} from the previous export that wrote the conversation, None if the conversation is new
+    def __init__(self, destination_path, conversation, previous):
+        os.makedirs(destination_path + '/' + STORE_FOLDER, exist_ok=True)
+        ConversationFile.__init__(self, message_store_filename(destination_path, conversation), previous)
+
+    def write(self, record):
+        self.file.write(STORE_ENCODER.encode(record) + '\n')
+
+
+# Writes a conversation as JSON lines (e.g. +11234567890.jsonl), one object per message: {date, sender, from_me, service, text, attachments}.
+# sender is None for messages the user sent, and attachments lists the paths of the copied attachments relative to the destination
+class JsonlRenderer(ConversationFile):
+    ## destination_path: The path specified where the files will be output to
+    ## conversation: {name, ...} of the conversation (see write_conversation)
+    ## previous: {size} from the previous export that wrote the file, None to write it from scratch
+    ## page_size: not used (the whole conversation goes in one file)
+    def __init__(self, destination_path, conversation, previous=None, page_size=None):
+        ConversationFile.__init__(self, destination_path + '/' + conversation['name'] + '.jsonl', previous)
+
+    def write(self, record):
+        self.file.write(json.dumps(dict(zip(CSV_COLUMNS, flatten_record(record))), ensure_ascii=False) + '\n')
+
+
+# Writes a conversation as a spreadsheet (e.g. +11234567890.csv) with a row per message. Attachments are separated by spaces
+class CsvRenderer(ConversationFile):
+    ## destination_path: The path specified where the files will be output to
+    ## conversation: {name, ...} of the conversation (see write_conversation)
+    ## previous: {size} from the previous export that wrote the file, None to write it from scratch
+    ## page_size: not used (the whole conversation goes in one file)
+    def __init__(self, destination_path, conversation, previous=None, page_size=None):
+        ConversationFile.__init__(self, destination_path + '/' + conversation['name'] + '.csv', previous)
+        self.writer = csv.writer(self.file)
+
+    def start(self):
+        csv.writer(self.file).writerow(CSV_COLUMNS)
+
+    def write(self, record):
+        row = flatten_record(record)
+        row[5] = ' '.join(row[5])
+        self.writer.writerow(row)
+
+
+# Columns of the csv files and keys of the jsonl files
+CSV_COLUMNS = ['date', 'sender', 'from_me', 'service', 'text', 'attachments']
+
+
+# The values of a record for the csv and jsonl files, in the order of CSV_COLUMNS
+## record: the message (see extract_messages)
+### returns: list of date string, sender (None if the user sent it), from_me, service, text and list of attachment paths
+def flatten_record(record):
+    attachments = [attachment['file'] for attachment in record['attachments'] if attachment['file'] is not None]
+    return [record['date_string'], None if record['from_me'] else record['sender'], record['from_me'], record['service'], record['text'], attachments]
+
+
+# Adds a conversation's messages to the search index (see SEARCH_DATABASE_FILENAME). The messages are staged a batch at a time in a temporary
+# table of the renderer's own connection, so only one batch is ever held in memory and search.db isn't locked while the conversation is rendered
+# (workers exporting other conversations can add theirs meanwhile). They are moved into the index in one short transaction once the
+# conversation is finished, so an interrupted export leaves nothing behind
+class SearchIndexRenderer(object):
+    ## destination_path: The path specified where the files will be output to
+    ## conversation: {name, ...} of the conversation (see write_conversation)
+    ## previous: {count} from the previous export that indexed the conversation, None to index it from scratch
+    ## page_size: not used
+    def __init__(self, destination_path, conversation, previous=None, page_size=None):
+        self.filename = destination_path + '/' + SEARCH_DATABASE_FILENAME
+        self.name = conversation['name']
+        # Position (number of messages before it in the conversation) of the first message added this time
+        self.start = previous['count'] if previous is not None else 0
+        self.count = self.start
+        self.rows = []
+        # Opened (and the staging table created) when the first batch is added
+        self.search_db = None
+
+    # Only messages with some text are searchable (attachments on their own aren't), but every message counts towards the positions
+    def write(self, record):
+        text = record['text']
+        if text is not None and not ATTACHMENT_PLACEHOLDER.match(text):
+            self.rows.append((self.name, self.count, record['id'], record['date'], record['date_string'], None if record['from_me'] else record['sender'], text))
+            if len(self.rows) >= SEARCH_INSERT_BATCH_SIZE:
+                self.flush()
+        self.count += 1
+
+    # Add the collected messages to the staging table. It's in the connection's temp database, so this doesn't lock search.db
+    def flush(self):
+        if self.search_db is None:
+            self.search_db = connect_search_database(self.filename)
+            self.search_db.execute('CREATE TEMP TABLE staged_messages (conversation TEXT, position INTEGER, message_id INTEGER, date INTEGER, date_string TEXT, sender TEXT, text TEXT);')
+        with self.search_db:
+            self.search_db.executemany('INSERT INTO temp.staged_messages VALUES (?, ?, ?, ?, ?, ?, ?);', self.rows)
+        self.rows = []
+
+    # The full-text index is updated with one statement for the whole conversation, which is several times faster than a row at a time
+    ### returns: {count} for ExportState
+    def close(self):
+        self.flush()
+        added = (self.name, self.start)
+        with self.search_db:
+            # Throw away anything an interrupted export added after the end of the previous export (or everything, when indexing from scratch)
+            self.search_db.execute("INSERT INTO messages_fts (messages_fts, rowid, text, sender, conversation) SELECT 'delete', id, text, sender, conversation FROM messages WHERE conversation = ? AND position >= ?;", added)
+            # Removing messages the static copy already has means it has to be written again from scratch
+            if self.search_db.execute('SELECT 1 FROM static_numbers WHERE id IN (SELECT id FROM messages WHERE conversation = ? AND position >= ?) LIMIT 1;', added).fetchone():
+                self.search_db.execute('DELETE FROM static_numbers;')
+            self.search_db.execute('DELETE FROM messages WHERE conversation = ? AND position >= ?;', added)
+            self.search_db.execute('INSERT INTO messages (conversation, position, message_id, date, date_string, sender, text) SELECT conversation, position, message_id, date, date_string, sender, text FROM temp.staged_messages ORDER BY rowid;')
+            self.search_db.execute('INSERT INTO messages_fts (rowid, text, sender, conversation) SELECT id, text, sender, conversation FROM messages WHERE conversation = ? AND position >= ?;', added)
+        self.search_db.close()
+        return {'count': self.count}
+
+    # Called instead of close() when the conversation fails. Closing the connection throws away the staging table
+    def abort(self):
+        if self.search_db is not None:
+            self.search_db.rollback()
+            self.search_db.close()
+            self.search_db = None
+
+
+# Number of messages SearchIndexRenderer collects before adding them to the search index
+SEARCH_INSERT_BATCH_SIZE = 5000
+
+
+# Output formats -> the class which writes a conversation in that format. Each is created with (destination_path, conversation, previous, page_size),
+# is given the conversation's records one at a time with write(record), and close() returns what the next export needs to append to the files
+RENDERERS = {'html': ConversationPages, 'jsonl': JsonlRenderer, 'csv': CsvRenderer, 'search': SearchIndexRenderer}
+
+
+# Name of the search index in the destination: an SQLite database with every message that has some text, and a full-text (FTS5) index over
+# the text, sender and conversation of each message. It is searched with the search command, and search.html searches a static copy of it
+SEARCH_DATABASE_FILENAME = 'search.db'
+
+# Tables of the search index. messages_fts indexes the messages table (rather than holding its own copy of them), so messages have to be added to
+# and removed from it along with the messages table (see SearchIndexRenderer).
+## conversation: name of the conversation (see write_conversation)
+## position: number of messages before this one in the conversation, which tells which html page it is on (see conversation_page)
+## message_id: ROWID of the message in sms.db (the html pages have an anchor for each message, e.g. #m1234)
+## date: apple's timestamp of the message (nanoseconds since 1/1/2001)
+## static_numbers, static_conversations: number of each message and conversation in the static copy of the index (see write_static_search_index)
+SEARCH_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, conversation TEXT, position INTEGER, message_id INTEGER, date INTEGER, date_string TEXT, sender TEXT, text TEXT);
+    CREATE INDEX IF NOT EXISTS messages_conversation ON messages (conversation, position);
+    CREATE INDEX IF NOT EXISTS messages_date ON messages (date);
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(text, sender, conversation, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2');
+    CREATE TABLE IF NOT EXISTS static_numbers (id INTEGER PRIMARY KEY, number INTEGER UNIQUE);
+    CREATE TABLE IF NOT EXISTS static_conversations (name TEXT PRIMARY KEY, number INTEGER);
+"""
+
+
+# Opens the search index for writing, creating it if it doesn't exist yet
+## filename: path of the search index
+### returns: sqlite3 connection. Worker processes take turns writing to it, so it waits for the others rather than failing
+def connect_search_database(filename):
+    search_db = sqlite3.connect(filename, timeout=300)
+    search_db.executescript(SEARCH_SCHEMA)
+    return search_db
+
+
+# The html page which shows a message
+## conversation: the conversation's entry in ExportState
+## position: number of messages before the message in the conversation
+### returns: path of the page relative to the destination (e.g. +11234567890_pages/page_0002.html), or None if the conversation wasn't written as html
+def conversation_page(conversation, position):
+    html = conversation['outputs'].get('html')
+    if html is None:
+        return None
+    for number, (first_date, last_date, count) in enumerate(html['pages'], 1):
+        position -= count
+        if position < 0:
+            return conversation['name'] + '_pages/page_%04d.html' % number
+    return None
+
+
+# Folder in the destination which holds the static copy of the search index that search.html loads (a web page opened from disk can't read
+# search.db). Each file is a script which hands its part of the index to the page:
+## conversations_0.js: [title, url of the conversation's pages (without _pages/page_0001.html), position at which each page ends] of each conversation
+##                     (by conversation number: the order in which they were first added to the copy)
+## messages_N.js: number -> [conversation number, position, message_id, date_string, sender, text] of the messages numbered from N * SEARCH_MESSAGES_PER_SHARD.
+##                The messages are numbered in date order, and each export numbers the messages it adds after those, so the newest matches of a search
+##                are the ones with the highest numbers (except older history an export only now found, which comes after them until the copy is rewritten)
+## terms_X_B.js: term -> numbers of the messages of block B containing it (each as the difference from the one before), for the terms whose first
+##               two characters are X (as hexadecimal character codes, e.g. 68-65 for he). Block B holds the messages numbered from B * SEARCH_MESSAGES_PER_TERMS_BLOCK
+SEARCH_FOLDER = 'search'
+
+# Number of messages in each messages_N.js file of the static search index
+SEARCH_MESSAGES_PER_SHARD = 1000
+
+# Number of messages in each block of terms_X_B.js files of the static search index. A search loads one file per block for each word, and
+# an export rewrites the files of the blocks its new messages go in
+SEARCH_MESSAGES_PER_TERMS_BLOCK = 20000
+
+
+# Writes the static copy of the search index and search.html. Only the files holding messages added since the last time are rewritten: the new
+# messages are numbered after the ones already in the copy (static_numbers in search.db remembers the numbers given so far), so they only change
+# the last messages_N.js files and the terms_X_B.js files of the last block. The whole copy is written again when there's none yet, or when
+# messages already in it were removed from search.db (see SearchIndexRenderer.flush)
 ## destination_path: The path specified where the files will be output to
-## backup_path: the path to the iTunes iOS backup file specified to pull information from
-## status_index: An integer index variable which keeps track of progress in the progess bar
-## total_tasks: An integer holding the number of total conversation documents (including group chats). Considered '100%' for progress bar
+## state: ExportState listing the conversations
 ### returns: nothing
-def create_group_conversation_documents(all_rooms, db_cursor, destination_path, backup_path, status_index, total_tasks):
-    for room in enumerate(all_rooms):
-        cache_roomname = room[1][0]
-        if cache_roomname is not None:
-            # Get most-recent 'title' of groupchat. Users can change the name of the groupchat (or not set one at all...) Get the latest set name
-            group_name_query = 'SELECT group_title, max(date) FROM message WHERE cache_roomnames = \'' + cache_roomname + '\' AND group_title IS NOT NULL;'
-            db_cursor.execute(group_name_query)
-            room_name = db_cursor.fetchone()
-            # Ensure the name is in ascii
-            if room_name[0] is not None:
-                room_name = room_name[0].encode('ascii')
-            else:
-                # If the users never set a name for the group chat, just call it untitled
-                room_name = 'untitled'
+def write_static_search_index(destination_path, state):
+    search_db_filename = destination_path + '/' + SEARCH_DATABASE_FILENAME
+    page_filename = destination_path + '/search.html'
+    if not os.path.exists(search_db_filename):
+        return
+    folder = destination_path + '/' + SEARCH_FOLDER
+
+    search_db = connect_search_database(search_db_filename)
+    with search_db:
+        # Conversations keep their numbers too, so the messages already in the copy still point at the right one
+        for entry in sorted(state.conversations.values(), key=lambda entry: entry['title'].lower()):
+            search_db.execute('INSERT OR IGNORE INTO static_conversations (name, number) SELECT ?, count(*) FROM static_conversations;', (entry['name'],))
+        conversation_numbers = dict(search_db.execute('SELECT name, number FROM static_conversations;'))
+        conversations = [None] * len(conversation_numbers)
+        for entry in state.conversations.values():
+            html = entry['outputs'].get('html')
+            page_ends = list(itertools.accumulate(page[2] for page in html['pages'])) if html is not None else None
+            conversations[conversation_numbers[entry['name']]] = [entry['title'], urllib.parse.quote(entry['name']), page_ends]
+
+        count, last_id = search_db.execute('SELECT count(*), max(id) FROM static_numbers;').fetchone()
+        if count == 0 or not os.path.isdir(folder):
+            search_db.execute('DELETE FROM static_numbers;')
+            count, last_id = 0, 0
+            shutil.rmtree(folder, ignore_errors=True)
+            os.makedirs(folder)
+        # search.db gives new messages higher ids than any it already has, so the ones not in the copy yet are those after the last one in it
+        new_ids = [row[0] for row in search_db.execute('SELECT id FROM messages WHERE id > ? ORDER BY date, id;', (last_id,))]
+        search_db.executemany('INSERT INTO static_numbers (id, number) VALUES (?, ?);', zip(new_ids, itertools.count(count)))
+        total = count + len(new_ids)
+
+        # The last file of the copy may have room for some of the new messages, so it's written again along with the new ones
+        shard, messages = None, {}
+        for row in search_db.execute('SELECT s.number, m.conversation, m.position, m.message_id, m.date_string, m.sender, m.text FROM static_numbers s JOIN messages m ON m.id = s.id WHERE s.number >= ? ORDER BY s.number;',
+                                     (count // SEARCH_MESSAGES_PER_SHARD * SEARCH_MESSAGES_PER_SHARD if new_ids else total,)):
+            if row[0] // SEARCH_MESSAGES_PER_SHARD != shard:
+                if messages:
+                    write_search_file(folder, 'messages_' + str(shard) + '.js', search_script('messages', shard, messages))
+                shard, messages = row[0] // SEARCH_MESSAGES_PER_SHARD, {}
+            messages[row[0]] = [conversation_numbers.get(row[1])] + list(row[2:])
+        if messages:
+            write_search_file(folder, 'messages_' + str(shard) + '.js', search_script('messages', shard, messages))
+
+        # The terms of each block that got new messages are listed by indexing the block's messages on their own (the same way messages_fts
+        # indexes them), with their numbers as rowids
+        search_db.execute("CREATE VIRTUAL TABLE temp.block_fts USING fts5(text, sender, conversation, tokenize='unicode61 remove_diacritics 2');")
+        search_db.execute('CREATE VIRTUAL TABLE temp.block_terms USING fts5vocab(temp, block_fts, instance);')
+        for block in range(count // SEARCH_MESSAGES_PER_TERMS_BLOCK, (total - 1) // SEARCH_MESSAGES_PER_TERMS_BLOCK + 1 if new_ids else 0):
+            search_db.execute('DELETE FROM temp.block_fts;')
+            search_db.execute('INSERT INTO temp.block_fts (rowid, text, sender, conversation) SELECT s.number, m.text, m.sender, m.conversation FROM static_numbers s JOIN messages m ON m.id = s.id WHERE s.number >= ? AND s.number < ?;',
+                              (block * SEARCH_MESSAGES_PER_TERMS_BLOCK, (block + 1) * SEARCH_MESSAGES_PER_TERMS_BLOCK))
+            write_search_terms(folder, block, search_db.execute('SELECT term, doc FROM temp.block_terms;'))
+        search_db.execute('DROP TABLE temp.block_terms;')
+        search_db.execute('DROP TABLE temp.block_fts;')
+
+        write_changed_file(folder + '/conversations_0.js', search_script('conversations', 0, conversations))
+        page = io.StringIO()
+        write_html_header(page)
+        page.write('<h1>Search</h1><p><input id="query" type="search" size="50" placeholder="Search messages" autofocus></p><p id="summary"></p><table id="results"></table>')
+        page.write('<script>var messagesPerShard = ' + str(SEARCH_MESSAGES_PER_SHARD) + ', termsBlocks = ' + str(-(-total // SEARCH_MESSAGES_PER_TERMS_BLOCK)) + ';')
+        page.write(SEARCH_PAGE_SCRIPT + '</script>' + HTML_FOOTER)
+        write_changed_file(page_filename, page.getvalue())
+    search_db.close()
+
+
+# Writes the terms_X_B.js files of a block of the static search index
+## folder: the static copy's folder
+## block: number of the block
+## occurrences: cursor of (term, number of a message of the block containing it), in order of term (as fts5vocab lists them), so the terms of each file come one after another
+### returns: nothing
+def write_search_terms(folder, block, occurrences):
+    shard, terms = None, {}
+    for term, term_occurrences in itertools.groupby(occurrences, key=lambda row: row[0]):
+        if search_shard_name(term) != shard:
+            if terms:
+                write_search_file(folder, 'terms_' + shard + '_' + str(block) + '.js', search_script('terms', shard + '_' + str(block), terms))
+            shard, terms = search_shard_name(term), {}
+        differences = []
+        last_number = 0
+        for number in sorted({occurrence[1] for occurrence in term_occurrences}):
+            differences.append(number - last_number)
+            last_number = number
+        terms[term] = differences
+    if terms:
+        write_search_file(folder, 'terms_' + shard + '_' + str(block) + '.js', search_script('terms', shard + '_' + str(block), terms))
+
+
+# The X in the names of the terms_X_B.js files a term goes in (see SEARCH_FOLDER)
+def search_shard_name(term):
+    return '-'.join('%x' % ord(character) for character in term[:2])
+
+
+# A file of the static search index: a script which passes its data to searchLoaded() in search.html
+def search_script(kind, name, data):
+    return 'searchLoaded(' + json.dumps(kind) + ',' + json.dumps(str(name)) + ',' + json.dumps(data, ensure_ascii=False, separators=(',', ':')) + ');\n'
+
+
+# Files are replaced whole, so an interrupted export never leaves half of one behind
+def write_search_file(folder, filename, script):
+    with open(folder + '/' + filename + '.part', 'w', encoding='utf-8') as search_file:
+        search_file.write(script)
+    os.replace(folder + '/' + filename + '.part', folder + '/' + filename)
+
+
+# Writes a file of the static search index unless it already holds the text
+def write_changed_file(filename, text):
+    if os.path.exists(filename):
+        with open(filename, encoding='utf-8') as previous_file:
+            if previous_file.read() == text:
+                return
+    write_search_file(os.path.dirname(filename), os.path.basename(filename), text)
+
+
+# Searches the static search index from search.html. Query words are matched against the start of the indexed terms (so "pizz" finds pizza),
+# and only messages containing all of them are shown, newest first. The index files are loaded (as scripts, which works from disk) when needed
+SEARCH_PAGE_SCRIPT = """
+var loaded = {conversations: {}, messages: {}, terms: {}};
+var latestSearch = 0;
+var maxResults = 200;
+
+function searchLoaded(kind, name, data) {
+    loaded[kind][name] = data;
+}
+
+function load(kind, name) {
+    if (name in loaded[kind]) {
+        return Promise.resolve(loaded[kind][name]);
+    }
+    return new Promise(function (resolve) {
+        var script = document.createElement('script');
+        script.src = 'search/' + kind + '_' + name + '.js';
+        script.charset = 'utf-8';
+        script.onload = function () { resolve(loaded[kind][name]); };
+        script.onerror = function () { loaded[kind][name] = null; resolve(null); };
+        document.head.appendChild(script);
+    });
+}
+
+function queryTerms(query) {
+    return query.normalize('NFKD').replace(/[\\u0300-\\u036f]/g, '').toLowerCase().split(/[^\\p{L}\\p{N}]+/u).filter(function (term) { return term; });
+}
+
+function shardName(term) {
+    return Array.from(term).slice(0, 2).map(function (character) { return character.codePointAt(0).toString(16); }).join('-');
+}
+
+function findTerm(term) {
+    var blocks = [];
+    for (var block = 0; block < termsBlocks; block++) {
+        blocks.push(load('terms', shardName(term) + '_' + block));
+    }
+    return Promise.all(blocks).then(function (found) {
+        var ids = new Set();
+        var prefix = Array.from(term).length >= 2;
+        found.forEach(function (terms) {
+            for (var indexed in terms || {}) {
+                if (indexed === term || (prefix && indexed.startsWith(term))) {
+                    var id = 0;
+                    terms[indexed].forEach(function (difference) { id += difference; ids.add(id); });
+                }
+            }
+        });
+        return ids;
+    });
+}
+
+function pageLink(conversation, position, messageId) {
+    if (conversation[2] === null) {
+        return null;
+    }
+    for (var page = 0; page < conversation[2].length; page++) {
+        if (position < conversation[2][page]) {
+            return conversation[1] + '_pages/page_' + String(page + 1).padStart(4, '0') + '.html#m' + messageId;
+        }
+    }
+    return null;
+}
+
+function addCell(row, text, link) {
+    var cell = row.insertCell();
+    if (link) {
+        var anchor = document.createElement('a');
+        anchor.href = link;
+        anchor.textContent = text;
+        cell.appendChild(anchor);
+    } else {
+        cell.textContent = text;
+    }
+}
+
+function search() {
+    var searchNumber = ++latestSearch;
+    var terms = queryTerms(document.getElementById('query').value);
+    var summary = document.getElementById('summary');
+    var results = document.getElementById('results');
+    if (!terms.length) {
+        summary.textContent = '';
+        results.innerHTML = '';
+        return;
+    }
+    Promise.all([load('conversations', 0)].concat(terms.map(findTerm))).then(function (found) {
+        var conversations = found[0] || [];
+        var ids = Array.from(found[1]).filter(function (id) { return found.slice(2).every(function (other) { return other.has(id); }); });
+        ids.sort(function (a, b) { return b - a; });
+        var shown = ids.slice(0, maxResults);
+        var shards = Array.from(new Set(shown.map(function (id) { return Math.floor(id / messagesPerShard); })));
+        return Promise.all(shards.map(function (shard) { return load('messages', shard); })).then(function () {
+            if (searchNumber !== latestSearch) {
+                return;
+            }
+            summary.textContent = ids.length + ' messages found' + (ids.length > shown.length ? ' (showing the newest ' + shown.length + ')' : '');
+            results.innerHTML = '';
+            shown.forEach(function (id) {
+                var message = (loaded.messages[Math.floor(id / messagesPerShard)] || {})[id];
+                if (!message) {
+                    return;
+                }
+                var conversation = conversations[message[0]] || ['', '', null];
+                var row = results.insertRow();
+                addCell(row, message[3]);
+                addCell(row, conversation[0], pageLink(conversation, message[1], message[2]));
+                addCell(row, message[4] === null ? 'Me' : message[4]);
+                addCell(row, message[5]);
+            });
+        });
+    });
+}
+
+var searchTimer = null;
+document.getElementById('query').addEventListener('input', function () {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(search, 200);
+});
+"""
+
+
+# The search command: prints the messages of an archive that match a query, newest first
+## destination_path: the archive (the destination of a previous export)
+## query: FTS5 query (if it isn't valid FTS5 syntax, its words are searched for as they are)
+## after, before: only messages sent on/after and before these dates (apple timestamps, see parse_date), or None
+## limit: maximum number of messages to print
+### returns: nothing
+def search_archive(destination_path, query, after=None, before=None, limit=50):
+    search_db_filename = destination_path + '/' + SEARCH_DATABASE_FILENAME
+    if not os.path.exists(search_db_filename):
+        print('Error: ' + destination_path + ' has no search index. Make one with `render -d ' + destination_path + ' --format search`.')
+        sys.exit()
+    state = ExportState(destination_path + '/' + EXPORT_STATE_FILENAME)
+    conversations = {entry['name']: entry for entry in state.conversations.values()}
+
+    conditions = ''
+    parameters = []
+    if after is not None:
+        conditions += ' AND messages.date >= ?'
+        parameters.append(after)
+    if before is not None:
+        conditions += ' AND messages.date < ?'
+        parameters.append(before)
+    search_query = ('SELECT messages.conversation, position, message_id, date_string, messages.sender, messages.text FROM messages_fts '
+                    'JOIN messages ON messages.id = messages_fts.rowid WHERE messages_fts MATCH ?' + conditions + ' ORDER BY messages.date DESC LIMIT ?;')
+
+    search_db = connect_read_only(search_db_filename)
+    try:
+        rows = search_db.execute(search_query, [query] + parameters + [limit]).fetchall()
+    except sqlite3.OperationalError:
+        # Not a valid FTS5 query (e.g. a phone number or email address), so search for each word as it is
+        words = ' '.join('"' + word.replace('"', '""') + '"' for word in query.split())
+        rows = search_db.execute(search_query, [words] + parameters + [limit]).fetchall()
+    search_db.close()
+
+    for conversation_name, position, message_id, date_string, sender, text in rows:
+        conversation = conversations.get(conversation_name)
+        title = conversation['title'] if conversation is not None else conversation_name
+        print(date_string + '  ' + title + '  ' + (sender if sender is not None else 'Me') + ': ' + text)
+        page = conversation_page(conversation, position) if conversation is not None else None
+        if page is not None:
+            print('    ' + os.path.join(destination_path, page) + '#m' + str(message_id))
+    print(str(len(rows)) + (' messages found' if len(rows) < limit else ' messages shown (use --limit to see more)'))
+
+
+# Checks the value of --after and --before
+## value: date as YYYY-MM-DD (in local time)
+### returns: the start of that day as an apple timestamp (nanoseconds since 1/1/2001), raises argparse.ArgumentTypeError if it isn't a date
+def parse_date(value):
+    try:
+        date = datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected a date like 2017-12-31, not ' + repr(value))
+    return int(time.mktime(date.timetuple()) - 978307200) * 1000000000
+
+
+# Name of the file in the destination which records how far previous exports got
+EXPORT_STATE_FILENAME = '.export_state.json'
+
+
+# Keeps track of what has already been exported so later runs only add new messages and resume where an interrupted run stopped.
+## floor: every message with a ROWID up to here was exported by a completed run
+## conversations: 'is_group:conversation' -> {name, title, group, message_id, date, messages, outputs}: the conversation (see write_conversation), the highest
+##                message ROWID written, the date of its last message, the number of messages and what the next export needs to append to each of its files (output format or 'store' -> what close() returned)
+## pending_attachments: destination filename -> [backup filename, mime type] for every attachment copy that hadn't finished when the state was saved
+class ExportState(object):
+    ## filename: the state file in the destination (it doesn't need to exist yet)
+    def __init__(self, filename):
+        self.filename = filename
+        self.floor = 0
+        self.ceiling = 0
+        self.conversations = {}
+        self.pending_attachments = {}
+        # Unfinished copies reported by worker processes (see export_conversations_in_parallel)
+        self.worker_pending = {}
+        self.last_saved = time.time()
+        if os.path.exists(filename):
+            with open(filename, encoding='utf-8') as state_file:
+                saved = json.load(state_file)
+            self.floor = saved['floor']
+            self.conversations = saved['conversations']
+            self.pending_attachments = saved['pending_attachments']
+
+    # Record the high-water mark of a conversation that has just been written
+    ## key: see conversation_key
+    ## entry: {name, title, group, message_id, date, messages, outputs}
+    ## copier: AttachmentCopier which copies attachments to the destination
+    def record(self, key, entry, copier):
+        self.conversations[key] = entry
+        self.checkpoint(copier)
+
+    # Take in a checkpoint sent by a worker process
+    ## index: number of the worker
+    ## conversations: high-water marks the worker recorded since its last checkpoint
+    ## pending: the worker's unfinished copies
+    def merge(self, index, conversations, pending):
+        self.conversations.update(conversations)
+        self.worker_pending[index] = pending
+
+    # Save the state every few seconds while exporting. A crash loses at most the last few conversations, which are simply redone
+    ## copier: AttachmentCopier whose unfinished copies are recorded alongside the conversations
+    def checkpoint(self, copier, interval=2.0):
+        if time.time() - self.last_saved >= interval:
+            self.save(copier)
+
+    # Write the state file. It is written to a temporary file first so a crash can't leave a corrupt state behind
+    ## copier: AttachmentCopier whose unfinished copies are recorded alongside the conversations (None to keep the ones loaded from the file)
+    def save(self, copier=None):
+        if copier is not None:
+            self.pending_attachments = copier.pending_copies()
+            for pending in self.worker_pending.values():
+                self.pending_attachments.update(pending)
+        temporary_filename = self.filename + '.part'
+        with open(temporary_filename, 'w', encoding='utf-8') as state_file:
+            json.dump({'floor': self.floor, 'conversations': self.conversations, 'pending_attachments': self.pending_attachments}, state_file)
+        os.replace(temporary_filename, self.filename)
+        self.last_saved = time.time()
+
+
+# Get the most-recent 'title' of each group chat
+## db_cursor: SQL cursor for the backup database
+### returns: dictionary of cache_roomnames -> latest group title (group chats which were never named are left out)
+def get_group_titles(db_cursor):
+    # SQLite returns the group_title from the same row as max(date)
+    db_cursor.execute('SELECT cache_roomnames, group_title, max(date) FROM message WHERE cache_roomnames IS NOT NULL AND group_title IS NOT NULL GROUP BY cache_roomnames;')
+    return {row[0]: row[1] for row in db_cursor}
+
+
+# Count the messages an export writes
+## db_cursor: SQL cursor for the backup database
+## floor, ceiling: range of message ROWIDs to export (see ExportState)
+### returns: number of messages in the range, considered '100%' for the progress bar
+def count_messages(db_cursor, floor, ceiling):
+    db_cursor.execute('SELECT COUNT(*) FROM message WHERE ROWID > ? AND ROWID <= ?;', (floor, ceiling))
+    return db_cursor.fetchone()[0]
+
+
+# Save the measurements of a run (see ExportProgress.report)
+## filename: the JSON file to write
+## metrics: dictionary to save
+### returns: nothing
+def save_metrics(filename, metrics):
+    with open(filename, 'w', encoding='utf-8') as metrics_file:
+        json.dump(metrics, metrics_file, indent=2)
+        metrics_file.write('\n')
+    print('Metrics saved to ' + filename)
+
+
+# Progress bar over the messages being exported, and measurements of where the time goes (see --metrics). The stages are:
+##   manifest (loading Manifest.db), working_copy (see --working-copy), attachment_plan (see print_attachment_plan), query (SQLite producing
+##   the message rows), extract (turning the rows into records, see extract_messages), store (writing the message store), render_<format>
+##   (writing each output format), read_store (reading the message store back, see render_conversations), missing_formats (writing
+##   formats earlier exports didn't write), search_page (see write_static_search_index) and copy_wait (waiting for the last attachment
+##   copies). The copies themselves overlap the other stages, so they are measured separately (see AttachmentCopier.statistics)
+## stages: stage name -> seconds spent in it
+## timed_seconds: total of the stage times so far. A stage that has other stages nested in it leaves their time out
+## slowest: heap of (seconds, messages, name) of the slowest conversations
+## copy_statistics: worker number -> the statistics of that worker process's AttachmentCopier (see AttachmentCopier.statistics)
+class ExportProgress(object):
+    ## bar: draw the progress bar. Without it (when the output goes to a log file) a line of progress is printed every PROGRESS_LOG_INTERVAL seconds
+    ## updates: connection to send (messages written, messages to export) to whenever the progress is drawn (see export_all_backups), or None
+    def __init__(self, bar=True, updates=None):
+        self.bar = bar
+        self.updates = updates
+        self.started = time.time()
+        self.stages = {}
+        self.timed_seconds = 0.0
+        self.slowest = []
+        self.copy_statistics = {}
+        # AttachmentCopier of this process, whose statistics are shown alongside the workers'
+        self.copier = None
+        self.conversations = 0
+        self.messages = 0
+        self.total_messages = 0
+        self.exporting_since = None
+        self.exporting_seconds = 0.0
+        self.last_drawn = 0
+        self.last_logged = 0
+        self.next_check = 0
+        self.complete = False
+        self.finished = False
+
+    # Times the code inside a with block as a stage
+    ## name: the stage 
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    ## stage: the stage 
+    ## seconds: time to add to it
+    def add_time(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        self.timed_seconds += seconds
+
+    # Starts the progress bar
+    ## messages: number of messages to export, considered '100%'
+    def begin(self, messages):
+        self.total_messages = messages
+        self.exporting_since = time.time()
+        self.draw(force=True)
+
+    # Called after each conversation
+    def advance(self, count=1):
+        self.conversations += count
+        self.draw()
+
+    # Called as messages are written. Checking the clock after every message would cost more than the redraws it saves, so it is only checked every 250 messages
+    def add_messages(self, count=1):
+        self.messages += count
+        if self.messages >= self.next_check:
+            self.next_check = self.messages + 250
+            self.draw()
+
+    # Keeps track of the slowest conversations
+    ## name: the conversation's name (see write_conversation)
+    ## messages: number of messages written
+    ## seconds: time it took to write them
+    def record_conversation(self, name, messages, seconds):
+        if len(self.slowest) < SLOWEST_CONVERSATIONS:
+            heapq.heappush(self.slowest, (seconds, messages, name))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, messages, name))
+
+    # Take in the measurements sent by a worker process (see WorkerChannel.send_progress)
+    ## index: number of the worker
+    ## update: {conversations, messages, stages, slowest, copy} measured since the worker's last update (copy is a running total)
+    def merge(self, index, update):
+        self.conversations += update['conversations']
+        self.messages += update['messages']
+        for stage, seconds in update['stages'].items():
+            self.add_time(stage, seconds)
+        for seconds, messages, name in update['slowest']:
+            self.record_conversation(name, messages, seconds)
+        self.copy_statistics[index] = update['copy']
+        self.draw()
+
+    # Statistics of every AttachmentCopier of the export added up (see AttachmentCopier.statistics)
+    def attachment_statistics(self):
+        totals = {}
+        for statistics in list(self.copy_statistics.values()) + ([self.copier.statistics()] if self.copier is not None else []):
+            for key, value in statistics.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
 
-            # Create new html file and call it the name of the group chat + the cached roomname from the backup (to avoid name collisions)
-            new_html_filename = destination_path + '/' + room_name + '_' + cache_roomname + '.html'
-            new_file = open(new_html_filename, "w")
-            lines_written = 0
+    # Redraws the progress bar with the rate, bytes copied and time left, at most 5 times a second
+    ## force: redraw even if the bar was just drawn
+    def draw(self, force=False):
+        now = time.time()
+        if self.finished or self.exporting_since is None or (not force and now - self.last_drawn < 0.2):
+            return
+        self.last_drawn = now
+        total = max(self.total_messages, 1)
+        done = total if self.complete else min(self.messages, total)
+        elapsed = now - self.exporting_since
+        rate = self.messages / elapsed if elapsed > 0 else 0
+        if done == total:
+            eta = 'done'
+        elif rate > 0:
+            eta = 'ETA ' + format_duration((total - done) / rate)
+        else:
+            eta = 'ETA --:--'
+        copied = self.attachment_statistics().get('bytes', 0)
+        suffix = '%d/%d messages  %d msg/s  %s copied  %s' % (self.messages, self.total_messages, rate, format_size(copied), eta)
+        if self.bar:
+            # Pad the suffix so a shorter line covers the end of the previous one
+            printProgressBar(done, total, prefix = 'Progress:', suffix = suffix.ljust(70), length = 40)
+        elif force or done == total or now - self.last_logged >= PROGRESS_LOG_INTERVAL:
+            self.last_logged = now
+            print(time.strftime('%H:%M:%S') + ' Progress: %.1f%% ' % (100.0 * done / total) + suffix, flush=True)
+        if self.updates is not None:
+            try:
+                self.updates.send((done, total))
+            except OSError:
+                # Nobody is listening any more, which doesn't stop the export
+                self.updates = None
+        if done == total:
+            self.finished = True
 
-            # Write out html header with CSS styling
-            write_html_header(new_file)
+    # Messages which don't belong to any conversation never show up in the query (and the count of new messages can't tell), so make sure the progress bar finishes
+    def finish(self):
+        self.exporting_seconds = time.time() - self.exporting_since
+        if not self.finished:
+            self.complete = True
+            self.draw(force=True)
 
-            new_file.write('<h1>' + room_name + ' Group Chat</h1>')
+    # The measurements of the run, as written by --metrics
+    ## extra: more entries for the report (e.g. the export's settings)
+    ### returns: dictionary which can be saved as JSON
+    def report(self, **extra):
+        seconds = time.time() - self.started
+        attachments = self.attachment_statistics()
+        metrics = dict(extra)
+        metrics.update({
+            'seconds': round(seconds, 3),
+            'conversations': self.conversations,
+            'messages': self.messages,
+            'messages_per_second': round(self.messages / self.exporting_seconds, 1) if self.exporting_seconds > 0 else None,
+            # The stages add up to (nearly) all of seconds, except for the attachment copies, which run in the background
+            'stages': {stage: round(self.stages[stage], 3) for stage in sorted(self.stages, key=lambda stage: -self.stages[stage])},
+            'attachments': {
+                'files': attachments.get('files', 0),
+                'bytes': attachments.get('bytes', 0),
+                'mb_per_second': round(attachments.get('bytes', 0) / 1024.0 / 1024.0 / seconds, 2) if seconds > 0 else None,
+                # Time the copy threads spent copying and making thumbnails, which overlaps the stages
+                'copy_seconds': round(attachments.get('copy_seconds', 0), 3),
+                'thumbnails': attachments.get('thumbnails', 0),
+                'thumbnail_seconds': round(attachments.get('thumbnail_seconds', 0), 3),
+                'linked': attachments.get('linked', 0),
+                'deduplicated': attachments.get('deduplicated', 0),
+                'failed': attachments.get('failed', 0),
+            },
+            'slowest_conversations': [{'name': name, 'messages': messages, 'seconds': round(seconds, 3)} for seconds, messages, name in sorted(self.slowest, reverse=True)],
+            'peak_rss_mb': peak_memory_usage(),
+        })
+        return metrics
 
-            # Write table header row
-            new_file.write('<table>')
+    # Prints how long the run took and where the time went
+    def print_summary(self):
+        attachments = self.attachment_statistics()
+        print('Wrote %d messages in %.1fs (%d msg/s), copied %d attachments (%s)' % (self.messages, time.time() - self.started,
+              self.messages / self.exporting_seconds if self.exporting_seconds > 0 else 0, attachments.get('files', 0), format_size(attachments.get('bytes', 0)))
+              + (', %d of them linked rather than copied' % attachments['linked'] if attachments.get('linked') else '')
+              + (', %d of them already in the attachment store' % attachments['deduplicated'] if attachments.get('deduplicated') else ''))
+        print('Time per stage: ' + ', '.join('%s %.1fs' % (stage, seconds) for stage, seconds in sorted(self.stages.items(), key=lambda item: -item[1]) if seconds >= 0.05))
 
-            # Get list of all messages sent or received in the group chat
-            group_messages_query = 'SELECT * FROM (SELECT * FROM (SELECT mess_hand_chat_join.mess_ROWID as message_id, mess_hand_chat_join.id as id, mess_hand_chat_join.text as text, mess_hand_chat_join.service as service, mess_hand_chat_join.cache_roomnames as cache_roomnames, mess_hand_chat_join.is_from_me as is_from_me, mess_hand_chat_join.date as \'date\', mess_hand_chat_join.date_read as date_read, mess_hand_chat_join.date_delivered as date_delivered, chat.ROWID as chat_id, chat.room_name as room_name FROM (SELECT * FROM (SELECT message.ROWID as mess_ROWID, handle.id as id, message.text as text, message.service as service, message.cache_roomnames as cache_roomnames, message.is_from_me as is_from_me, message.date as \'date\', message.date_read as date_read, message.date_delivered as date_delivered FROM message LEFT JOIN handle ON message.handle_id = handle.ROWID) as message_info INNER JOIN chat_message_join on message_info.mess_ROWID = chat_message_join.message_id) as mess_hand_chat_join INNER JOIN chat on mess_hand_chat_join.chat_id = chat.ROWID) as message_chat_info LEFT JOIN message_attachment_join on message_chat_info.message_id = message_attachment_join.message_id) as message_chat_att_join LEFT JOIN attachment on message_chat_att_join.attachment_id = attachment.ROWID WHERE cache_roomnames = \'' + cache_roomname + '\' ORDER BY message_chat_att_join.date ASC;'
-            db_cursor.execute(group_messages_query)
-            all_messages = db_cursor.fetchall()
 
-            # For each message create a row in the table with the message information
-            for message in all_messages:
-                # SQL Response column order -> [0,message_id][1,id][2,text][3,service][4,cache_roomnames][5,is_from_me][6,date][7,date_read][8,date_delivered][9,chat_id][10,room_name][11,message_id:1][12,attachment_id][13,ROWID][14,guid][15,created_date][16,start_date][17,filename][18,uti][19,mime_type][20,transfer_state][21,is_outgoing][22,user_info][23,transfer_name][24,total_bytes][25,is_sticker][26,sticker_user_info][27,attribution_info][28,hide_attachment][29,ck_sync_state][30,ck_server_change_token_blob][31,ck_record_id][32,original_guid]
-                phone_num = message[1]
-                text = message[2]
-                service = message[3]
-                is_from_me = message[5]
-                date_timestamp = message[6]
-                room_name = message[10]
-                attachment_filename = message[17]
-                mime_type = message[19]
+# Number of conversations listed in the slowest_conversations of --metrics
+SLOWEST_CONVERSATIONS = 10
 
-                lines_written += 1
-                # Print out the message as a row in the table
-                add_row_to_table(new_file, backup_path, destination_path, phone_num, text, service, is_from_me, date_timestamp, attachment_filename, mime_type, group=True)
+# Seconds between the lines of progress printed instead of the progress bar (see ExportProgress)
+PROGRESS_LOG_INTERVAL = 30
 
-            # End html file
-            new_file.write('</body></html>')
 
-            # If no lines written in html (due to no messages sent/recieved), just delete the created file
-            if lines_written < 1:
-                os.remove(new_html_filename)
+# Formats a number of seconds as h:mm:ss (or m:ss)
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds) if hours else '%d:%02d' % (minutes, seconds)
 
-            # Update Progress Bar before doing next group chat
-            status_index += 1
-            printProgressBar(status_index, total_tasks, prefix = 'Progress:', suffix = 'Complete', length = 50)
 
+# Peak memory usage of this process and of the worker processes it waited for
+### returns: the larger of the two in MB, or None where the resource module isn't available (Windows)
+def peak_memory_usage():
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    return round(peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0), 1)
 
-# Adds a single message as a row in the html table
+
+# Adds a single message as a row in the html table (a message with several attachments gets a row for each of them)
 ## new_file: html file we are writing the messages to
-## backup_path: path to the iOS backup (used to locate the attachments)
-## destination_path: path specified where files will be created
-## phone_num: phone number (or apple id, etc.) of user who sent this message
-## message: the message's content (actual text)
-## service: which service the text was sent over -- SMS or iMessage
-## is_from_me: 0 if user received message, 1 if user sent message
-## date_timestamp: timestamp of when message was sent/received
-## attachment_filename: if the message includes an attachment, this is the path/filename (can be None)
-## mime_type: if there is an attachment, this is the attachment's mime_type (e.g. image/gif, video/mp4...)
+## root_url: url of the destination folder relative to the html file
+## record: the message (see extract_messages)
 ## group: Boolean specifying if this function is being used in a group chat or single chat context (If used in group chat context the phone number is added to each message to make it clear who sent each message)
 ## returns: nothing
-def add_row_to_table(new_file, backup_path, destination_path, phone_num, message, service, is_from_me, date_timestamp, attachment_filename, mime_type, group=False):
-      new_file.write('<tr>')
-
-      # Message sent datetime stamp
-      new_file.write('<td style=\"text-align: right;\">' + str(convert_date_timestamp(date_timestamp)) + '</td>')
-
+def add_row_to_table(new_file, root_url, record, group=False):
       # The message text
+      message = record['text']
+      message_cell = ''
       if message is not None:
           # If there aren't any ascii characters in a message, assume it's an attachment
-          if ((all(ord(char) > 127 for char in message)) or (all(ord(char) < 32 for char in message))):
+          if ATTACHMENT_PLACEHOLDER.match(message):
               message = '<strong>*Attachment*</strong>'
 
           # Message Sender info
-          if is_from_me:
-              # If the user sent the message, then make the message blue if iMessage or green if SMS
-              if str(service) == 'iMessage':
-                  color = '#2184f7'
-              else:
-                  color = '#1eaf32'
-              new_file.write('<td style=\"background-color:' + color + '; color: white;\">' + message.encode('utf-8', errors='replace') + '</td>')
-          else:
+          if record['from_me']:
+              # The user sent the message. Blue bubble if iMessage or green if SMS
+              color = '#2184f7' if record['service'] == 'iMessage' else '#1eaf32'
+              message_cell = '<td style=\"background-color:' + color + '; color: white;\">' + message + '</td>'
+          elif group:
               # If using this function in group context, add the phone number which sent the message to the message
-              if group:
-                  new_file.write('<td style=\"background-color: #b8b8be;\"><small><i>(Sent By: ' + phone_num.encode('utf-8', errors='replace') + ')</i></small>' + message.encode('utf-8', errors='replace') + '</td>')
-              else:
-                  new_file.write('<td style=\"background-color: #b8b8be;\">' + message.encode('utf-8', errors='replace') + '</td>')
-
-      # Add the attachment (if there is one)
-      if attachment_filename is not None:
-          write_attachment_file(new_file, attachment_filename, mime_type, backup_path, destination_path)
-      else:
-          new_file.write('<td></td>')
-      new_file.write('</tr>')
+              message_cell = '<td style=\"background-color: #b8b8be;\"><small><i>(Sent By: ' + str(record['sender']) + ')</i></small>' + message + '</td>'
+          else:
+              message_cell = '<td style=\"background-color: #b8b8be;\">' + message + '</td>'
 
+      # The first row of each message can be linked to (e.g. page_0001.html#m1234) from the search results
+      row_start = '<tr id=\"m' + str(record['id']) + '\">'
+      for attachment in record['attachments'] or [None]:
+          new_file.write(row_start)
+          row_start = '<tr>'
 
-# Convert date from iOS Message timestamp
-# (apple's iOS backup calculates date from 1/1/2001 whereas unix is 1970, therefore we add 978307200 to compensate for this difference)
-# For whatever reason, it is also calculated down to the 1/1000000000 of a second... so we convert it to seconds)
-### returns: converted time as string
-def convert_date_timestamp(original_date_timestamp):
-  return datetime.datetime.fromtimestamp(original_date_timestamp/1000000000 + 978307200).strftime("%m/%d/%Y %H:%M:%S")
+          # Message sent datetime stamp
+          new_file.write('<td style=\"text-align: right;\">' + str(record['date_string']) + '</td>')
+          new_file.write(message_cell)
+
+          # Add the attachment (if there is one)
+          if attachment is not None:
+              write_attachment_file(new_file, attachment, root_url)
+          else:
+              new_file.write('<td></td>')
+          new_file.write('</tr>')
+
+
+# Messages made up entirely of non-ascii characters (e.g. the object replacement character) or entirely of control characters stand in for attachments
+ATTACHMENT_PLACEHOLDER = re.compile(r'(?:[^\x00-\x7f]*|[\x00-\x1f]*)\Z')
 
 
 # Writes the attachment as a cell in the html table
 ## new_file: the html file to write to
-## filename: unhashed filename from iOS message backup sql db
-## mime_type: the mime_type of the attachment (e.g. image/gif, video/mp4, etc.)
-## backup_path: path to the iOS backup
-## destination_path: path to the destination where we are putting the html files (we will also copy the attachments here)
+## attachment: {source, mime_type, file, thumbnail} (see locate_attachment)
+## root_url: url of the destination folder relative to the html file
 ### returns: nothing
-def write_attachment_file(new_file, filename, mime_type, backup_path, destination_path):
-  # Find hashed file in the backup folder
-  ## Filenames are given using relative path, change this to the mobile format of MediaDomain-Library
-  attachment_filename = filename.replace('~/Library', 'MediaDomain-Library')
-  ## Take the sha1 hash of the filename to find the hashed filename used in the backup
-  hashed_filename = hashlib.sha1(attachment_filename).hexdigest()
-  ## The backup also sorts each file into another folder by the first two letters in the filename
-  hashed_folder = hashed_filename[:2]
-  ## Make a complete path to the hashed attachment file
-  attachment_filename = backup_path + '/' + hashed_folder + '/' + hashed_filename
-  ## Create the path where we will put the attachments in our backup
-  destination_attachments_path = destination_path + '/attachments'
-  ## Create the full destination filename with path for this attachment file
-  destination_filename = destination_attachments_path + '/' + hashed_filename
-
-  # Create an attachments folder in our destination path if we haven't already
-  if not os.path.exists(destination_attachments_path):
-      os.makedirs(destination_attachments_path)
-
-  # Add extension to video files by mime_type. This will allow them to play in browser. (Images seem to work without adding an extension)
-  if mime_type is not None and mime_type == 'video/mp4':
-      destination_filename = destination_filename + '.mp4'
-  elif mime_type is not None and mime_type == 'video/quicktime':
-      destination_filename = destination_filename + '.mov'
-
-  # Copy attachment to destination folder so we can still reference the file even if the original backup is deleted
-  if os.path.exists(attachment_filename):
-      shutil.copyfile(attachment_filename, destination_filename)
-
-      # Write out attachment file to the html table using the appropriate tag. If it isn't an image or video, just put a link to the file path
-      if mime_type is not None and mime_type[:5] == 'image':
-          new_file.write('<td><img src=\"' + destination_filename + '\"></td>')
-      elif mime_type is not None and mime_type[:5] == 'video':
-          new_file.write('<td><video controls><source src=\"' + destination_filename + '\"; type=\"' + mime_type + '\";>Your browser does not support the video tag.</video></td>')
-      elif mime_type is not None:
-          new_file.write('<td><a href=\"' + destination_filename + '\">Mime-Type: ' + mime_type + ' | Source: ' + destination_filename + '</a></td>')
+def write_attachment_file(new_file, attachment, root_url):
+  if attachment['file'] is None:
+      # The attachment isn't in the backup
+      new_file.write('<td></td>')
+      return
+  mime_type = attachment['mime_type']
+  attachment_url = root_url + '/' + urllib.parse.quote(attachment['file'])
+
+  # Images and videos show a small thumbnail (if one can be made) which links to the original
+  thumbnail_filename = attachment['thumbnail']
+  if thumbnail_filename is not None:
+      thumbnail_url = root_url + '/' + urllib.parse.quote(thumbnail_filename)
+
+  # Write out attachment file to the html table using the appropriate tag. If it isn't an image or video, just put a link to the file path.
+  # Images are only loaded once they are scrolled to, and videos once they are played
+  if mime_type is not None and mime_type[:5] == 'image':
+      if thumbnail_filename is not None:
+          # If the thumbnail couldn't be made (e.g. a format Pillow doesn't read), fall back to the original
+          new_file.write('<td><a href=\"' + attachment_url + '\"><img src=\"' + thumbnail_url + '\" loading=\"lazy\" onerror=\"this.onerror=null;this.src=\'' + attachment_url + '\'\"></a></td>')
       else:
-          new_file.write('<td><a href=\"' + destination_filename + '\">Mime-Type: No Type Specified | Source: ' + destination_filename + '</a></td>')
+          new_file.write('<td><img src=\"' + attachment_url + '\" loading=\"lazy\"></td>')
+  elif mime_type is not None and mime_type[:5] == 'video':
+      poster = ' poster=\"' + thumbnail_url + '\"' if thumbnail_filename is not None else ''
+      new_file.write('<td><video controls preload=\"none\"' + poster + '><source src=\"' + attachment_url + '\"; type=\"' + mime_type + '\";>Your browser does not support the video tag.</video></td>')
+  elif mime_type is not None:
+      new_file.write('<td><a href=\"' + attachment_url + '\">Mime-Type: ' + mime_type + ' | Source: ' + attachment_url + '</a></td>')
   else:
-      # Something went wrong... likely the attachment was deleted
-      new_file.write('<td></td>')
+      new_file.write('<td><a href=\"' + attachment_url + '\">Mime-Type: No Type Specified | Source: ' + attachment_url + '</a></td>')
+
+
+# The domain and path of sms.db within the backup. (3d0d7e5fb2ce288813306e4d4636395e047a3d28 is the sha1 hash of this, i.e. the hashed name of the sms.db file)
+SMS_DB_DOMAIN_PATH = 'HomeDomain-Library/SMS/sms.db'
+
+
+# Index of the files in an iOS backup. Files in the backup are named by the sha1 hash of their domain and path on the phone, and sorted into
+# folders by the first two letters of that hash. Newer backups (iOS 10+) list every file in Manifest.db along with its size, so that is loaded
+# once and finding a file is a dictionary lookup. Older backups don't have a Manifest.db, so the hash is worked out and checked on disk instead.
+class BackupManifest(object):
+    ## backup_path: the path to the iTunes iOS backup
+    ## indexed: False not to load the Manifest.db (and look the files up by their well-known hashed names)
+    def __init__(self, backup_path, indexed=True):
+        self.backup_path = backup_path
+        # 'Domain-relative/path' -> (hashed filename, size in bytes)
+        self.files = {}
+        # Without a Manifest.db, remembers what has already been looked up on disk
+        self.found = {}
+        self.indexed = indexed and os.path.exists(backup_path + '/Manifest.db')
+        if self.indexed:
+            self.load(backup_path + '/Manifest.db')
+
+    # Load the message database and the attachments (flags = 1 are regular files) from Manifest.db
+    def load(self, manifest_filename):
+        conn = connect_read_only(manifest_filename)
+        db_cursor = conn.cursor()
+        db_cursor.execute('SELECT fileID, domain, relativePath, file FROM Files WHERE flags = 1 AND ((domain = \'MediaDomain\' AND relativePath LIKE \'Library/SMS/%\') OR (domain = \'HomeDomain\' AND relativePath = \'Library/SMS/sms.db\'));')
+        for file_id, domain, relative_path, file_info in db_cursor:
+            self.files[domain + '-' + relative_path] = (file_id, get_manifest_file_size(file_info))
+        conn.close()
+
+    # Full path of a hashed file in the backup
+    def file_path(self, hashed_filename):
+        return self.backup_path + '/' + hashed_filename[:2] + '/' + hashed_filename
+
+    # Path of the sms.db file in the backup
+    def sms_db_path(self):
+        sms_db = self.find(SMS_DB_DOMAIN_PATH)
+        if sms_db is None:
+            # Not listed in the manifest (or it is in a format we don't understand). Fall back to the well-known hashed name
+            return self.file_path(hashlib.sha1(SMS_DB_DOMAIN_PATH.encode('utf-8')).hexdigest())
+        return self.file_path(sms_db[0])
+
+    # Find a file in the backup
+    ## domain_path: the file's domain and path on the phone (e.g. MediaDomain-Library/SMS/Attachments/...)
+    ### returns: (hashed filename, size in bytes or None if unknown), or None if the file isn't in the backup
+    def find(self, domain_path):
+        if self.indexed:
+            return self.files.get(domain_path)
+        if domain_path not in self.found:
+            hashed_filename = hashlib.sha1(domain_path.encode('utf-8')).hexdigest()
+            self.found[domain_path] = (hashed_filename, None) if os.path.exists(self.file_path(hashed_filename)) else None
+        return self.found[domain_path]
+
+    # Find an attachment in the backup
+    ## filename: the attachment's filename from the sms.db attachment table
+    ### returns: (hashed filename, size in bytes or None if unknown), or None if the attachment isn't in the backup
+    def find_attachment(self, filename):
+        # Filenames are given using relative path (or the absolute path on the phone), change this to the mobile format of MediaDomain-Library
+        domain_path = filename.replace('~/Library', 'MediaDomain-Library').replace('/var/mobile/Library', 'MediaDomain-Library')
+        return self.find(domain_path)
+
+
+# Manifest.db stores the details of each file (size, modified date, etc.) as an NSKeyedArchiver plist
+## file_info: the 'file' blob from the Manifest.db Files table
+### returns: size of the file in bytes, or None if it can't be read
+def get_manifest_file_size(file_info):
+    try:
+        archive = plistlib.loads(file_info)
+        return archive['$objects'][archive['$top']['root'].data]['Size']
+    except Exception:
+        return None
+
+
+# Prints how many attachments are going to be copied and how much space they need, and how many are missing from the backup
+## db_cursor: SQL cursor for the backup database
+## manifest: BackupManifest used to locate the attachments in the backup
+## floor: only attachments of messages newer than this ROWID are counted (see ExportState)
+### returns: nothing
+def print_attachment_plan(db_cursor, manifest, floor):
+    db_cursor.execute('SELECT DISTINCT attachment.filename FROM message_attachment_join INNER JOIN attachment ON message_attachment_join.attachment_id = attachment.ROWID WHERE message_attachment_join.message_id > ? AND attachment.filename IS NOT NULL;', (floor,))
+    files = set()
+    missing = 0
+    for (filename,) in db_cursor:
+        backup_file = manifest.find_attachment(filename)
+        if backup_file is None:
+            missing += 1
+        else:
+            files.add(backup_file)
+    total_size = sum(size for hashed_filename, size in files if size is not None)
+    print('Attachments: ' + str(len(files)) + ' files (' + format_size(total_size) + ') to copy, ' + str(missing) + ' missing from the backup')
+
+
+# Formats a number of bytes for people to read (e.g. 1.5 GB)
+def format_size(num_bytes):
+    for unit in ['bytes', 'KB', 'MB', 'GB']:
+        if num_bytes < 1024:
+            break
+        num_bytes /= 1024.0
+    else:
+        unit = 'TB'
+    return ('%d %s' if unit == 'bytes' else '%.1f %s') % (num_bytes, unit)
+
+
+# Copies attachments out of the backup on a bounded pool of background threads, so writing the html never has to wait on the disk.
+# Each attachment is only copied once no matter how many times it shows up (forwarded pictures, messages joined to several chats, etc.)
+class AttachmentCopier(object):
+    ## destination_path: the attachments folder in the destination
+    ## workers: maximum number of copies running at the same time
+    ## link_mode: 'copy', 'hardlink' or 'reflink'. Links fall back to a normal copy if the filesystem doesn't support them
+    ## thumbnails: make thumbnails of images (if Pillow is installed) and videos (if ffmpeg is installed) once they are copied
+    ## store: AttachmentStore to put the attachments in, which the destination only links to (None to copy them straight to the destination)
+    ## budget: IOBudget limiting how fast the copies read and write (None for no limit)
+    def __init__(self, destination_path, workers=8, link_mode='copy', thumbnails=True, store=None, budget=None):
+        self.destination_path = destination_path
+        self.workers = workers
+        self.link_mode = link_mode
+        self.thumbnails = thumbnails
+        self.store = store
+        self.budget = budget
+        self.ffmpeg = shutil.which('ffmpeg') if thumbnails else None
+        self.failed = 0
+        self.thumbnails_failed = 0
+        # Work done by the copy threads (see statistics)
+        self.files_copied = 0
+        self.bytes_copied = 0
+        self.files_linked = 0
+        self.deduplicated = 0
+        self.copy_seconds = 0.0
+        self.thumbnails_made = 0
+        self.thumbnail_seconds = 0.0
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        # destination filenames which have been queued
+        self.submitted = set()
+        # destination filename -> [source filename, mime type] of every copy that hasn't completed (successfully) yet
+        self.pending = {}
+        self.folder_created = False
+        self.lock = threading.Lock()
+
+    # Queue a copy of an attachment (if it hasn't been queued already)
+    ## source: path of the hashed file in the backup
+    ## destination: path the attachment should be copied to
+    ## size: size of the file from the backup's manifest (None if unknown)
+    ## mime_type: the attachment's mime type, used to decide whether to make a thumbnail
+    ### returns: nothing
+    def submit(self, source, destination, size=None, mime_type=None):
+        if destination not in self.submitted:
+            self.submitted.add(destination)
+            # Create an attachments folder (and thumbnails folder) in our destination path if we haven't already
+            if not self.folder_created:
+                os.makedirs(self.destination_path + '/' + THUMBNAILS_FOLDER, exist_ok=True)
+                self.folder_created = True
+            with self.lock:
+                self.pending[destination] = [source, mime_type]
+            self.executor.submit(self.copy, source, destination, size, mime_type).add_done_callback(self.copy_done)
+
+    # Where the thumbnail of an attachment goes
+    ## destination: path the attachment is copied to
+    ## mime_type: the attachment's mime type
+    ### returns: path of the thumbnail, or None if no thumbnail is made for this attachment
+    def thumbnail_filename(self, destination, mime_type):
+        if mime_type is None or not self.thumbnails:
+            return None
+        if (mime_type[:5] == 'image' and Image is not None) or (mime_type[:5] == 'video' and self.ffmpeg is not None):
+            return self.destination_path + '/' + THUMBNAILS_FOLDER + '/' + os.path.basename(destination) + '.jpg'
+        return None
+
+    # Runs on a worker thread. Files already in the destination (e.g. from a previous run) are left alone, unless their size doesn't match the backup
+    def copy(self, source, destination, size, mime_type):
+        if not os.path.exists(destination) or (size is not None and os.path.getsize(destination) != size):
+            start = time.perf_counter()
+            source_size = os.path.getsize(source)
+            # Only data which was actually copied counts towards the bytes, not links and clones
+            bytes_copied = 0
+            if self.store is not None:
+                # The data is only copied if the store doesn't have it yet. The destination just gets a link to it (or a copy, if the store is on another filesystem)
+                stored, copied = self.store.add(source, self.link_mode, self.budget)
+                if place_file(stored, destination, 'hardlink'):
+                    bytes_copied += source_size
+            else:
+                if self.budget is not None and self.link_mode == 'copy':
+                    self.budget.spend(source_size)
+                copied = place_file(source, destination, self.link_mode)
+            if copied:
+                bytes_copied += source_size
+            copy_seconds = time.perf_counter() - start
+            with self.lock:
+                self.files_copied += 1
+                self.bytes_copied += bytes_copied
+                if copied is None:
+                    self.deduplicated += 1
+                elif not copied:
+                    self.files_linked += 1
+                self.copy_seconds += copy_seconds
+        thumbnail = self.thumbnail_filename(destination, mime_type)
+        if thumbnail is not None and not os.path.exists(thumbnail):
+            start = time.perf_counter()
+            try:
+                make_thumbnail(destination, thumbnail, mime_type, self.ffmpeg)
+            except Exception:
+                # The pages fall back to the original attachment
+                with self.lock:
+                    self.thumbnails_failed += 1
+            else:
+                thumbnail_seconds = time.perf_counter() - start
+                with self.lock:
+                    self.thumbnails_made += 1
+                    self.thumbnail_seconds += thumbnail_seconds
+        with self.lock:
+            del self.pending[destination]
+
+    def copy_done(self, future):
+        if future.exception() is not None:
+            with self.lock:
+                self.failed += 1
+
+    # Remove the temporary files of copies and thumbnails which were interrupted (see place_file). Only safe while nothing is being copied
+    def remove_partial_files(self):
+        for folder in [self.destination_path, self.destination_path + '/' + THUMBNAILS_FOLDER]:
+            if os.path.isdir(folder):
+                for entry in os.scandir(folder):
+                    if entry.name.endswith('.part'):
+                        os.remove(entry.path)
+
+    # Snapshot of the copies which haven't completed yet (failed copies stay in here so a later run can retry them)
+    ### returns: dictionary of destination filename -> [source filename, mime type]
+    def pending_copies(self):
+        with self.lock:
+            return dict(self.pending)
+
+    # What the copy threads have done so far. The seconds are added up over the threads, so they can be more than the time the export took
+    ### returns: {files, bytes, linked, deduplicated, copy_seconds, thumbnails, thumbnail_seconds, failed}, where files counts the attachments placed in
+    ###          the destination (files already there aren't counted), bytes the data actually copied, linked the files which were hardlinked or
+    ###          cloned (from the backup, or into the store) rather than copied, and deduplicated those the store already had. Neither of those cost any bytes
+    def statistics(self):
+        with self.lock:
+            return {'files': self.files_copied, 'bytes': self.bytes_copied, 'linked': self.files_linked, 'deduplicated': self.deduplicated, 'copy_seconds': self.copy_seconds,
+                    'thumbnails': self.thumbnails_made, 'thumbnail_seconds': self.thumbnail_seconds, 'failed': self.failed}
+
+    # Wait for every queued copy to finish
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+# Folder inside the attachments folder which holds the thumbnails
+THUMBNAILS_FOLDER = 'thumbnails'
+
+
+# Limits how much attachment data is read and written (see --io-budget). Each copy thread waits for its turn before it copies a file,
+# so the copies stay within the budget on average (a single big file may go over it for a moment). The turns are kept in shared memory,
+# so every process it's handed to (the exports of --all-backups and the workers of --jobs) takes them from the one budget
+class IOBudget(object):
+    ## bytes_per_second: the budget
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = float(bytes_per_second)
+        # When the bytes spent so far will have been paid off, on the monotonic clock (which is the same in every process). Time spent idle
+        # isn't saved up for later
+        self.free_at = multiprocessing.get_context('spawn').Value('d', time.monotonic())
+
+    # Wait until there is budget for a file
+    ## num_bytes: size of the file about to be read or written
+    def spend(self, num_bytes):
+        with self.free_at.get_lock():
+            now = time.monotonic()
+            start = max(now, self.free_at.value)
+            self.free_at.value = start + num_bytes / self.bytes_per_second
+        if start > now:
+            time.sleep(start - now)
+
+
+# Folder in the destination of --all-backups which holds the AttachmentStore shared by the archives
+SHARED_ATTACHMENTS_FOLDER = 'shared_attachments'
+
+# Log of each export of --all-backups, in the backup's archive
+EXPORT_LOG_FILENAME = 'export.log'
+
+# Name of the attachment store's cache of content hashes
+ATTACHMENT_STORE_INDEX_FILENAME = 'index.db'
+
+# Cache of the content hash of each attachment in the backups, so a file doesn't have to be read again to find out whether the store already has it.
+# Files are identified by their hashed filename in the backup, their size and their modification time
+ATTACHMENT_STORE_SCHEMA = """
+    PRAGMA journal_mode = WAL;
+    PRAGMA synchronous = NORMAL;
+    CREATE TABLE IF NOT EXISTS content_hashes (file_id TEXT, size INTEGER, modified INTEGER, hash TEXT, PRIMARY KEY (file_id, size, modified)) WITHOUT ROWID;
+"""
+
+
+# Content-addressed store of attachments, which the archives of several backups (e.g. of different phones, see --all-backups) and runs share.
+# Each attachment is stored once, named after the SHA-256 of its content (ab/abcdef...), and the attachments folder of an archive only holds
+# hard links to it, so a picture which is in several backups only takes up space (and copy time) once
+class AttachmentStore(object):
+    ## path: the store's folder (it doesn't need to exist yet)
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        # The copy threads take turns with the connection. Several processes may use the index at once, hence the long timeout
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path + '/' + ATTACHMENT_STORE_INDEX_FILENAME, timeout=300, isolation_level=None, check_same_thread=False)
+        self.conn.executescript(ATTACHMENT_STORE_SCHEMA)
+
+    # Path of a file in the store
+    def file_path(self, content_hash):
+        return self.path + '/' + content_hash[:2] + '/' + content_hash
+
+    # Put a file into the store (unless the store already has its content)
+    ## source: path of the hashed file in the backup
+    ## link_mode: 'copy', 'hardlink' or 'reflink' (see place_file)
+    ## budget: IOBudget the reads and writes are counted against (None for no limit)
+    ### returns: (path of the file in the store, whether its data was copied into the store (see place_file) or None if the store already had it)
+    def add(self, source, link_mode='copy', budget=None):
+        stat = os.stat(source)
+        key = (os.path.basename(source), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            row = self.conn.execute('SELECT hash FROM content_hashes WHERE file_id = ? AND size = ? AND modified = ?;', key).fetchone()
+        if row is not None:
+            content_hash = row[0]
+        else:
+            if budget is not None:
+                budget.spend(stat.st_size)
+            content_hash = hash_file(source)
+            with self.lock:
+                self.conn.execute('INSERT OR REPLACE INTO content_hashes VALUES (?, ?, ?, ?);', key + (content_hash,))
+
+        stored = self.file_path(content_hash)
+        if os.path.exists(stored):
+            return stored, None
+        if budget is not None and link_mode == 'copy':
+            budget.spend(stat.st_size)
+        os.makedirs(os.path.dirname(stored), exist_ok=True)
+        return stored, place_file(source, stored, link_mode)
+
+    # Remove the temporary files of copies which were interrupted (see place_file). Only safe while nothing is being added to the store
+    def remove_partial_files(self):
+        for folder in os.scandir(self.path):
+            if folder.is_dir():
+                for entry in os.scandir(folder.path):
+                    if entry.name.endswith('.part'):
+                        os.remove(entry.path)
+
+    # Number and total size of the files in the store
+    ### returns: (number of files, bytes)
+    def usage(self):
+        files = 0
+        total_size = 0
+        for folder in os.scandir(self.path):
+            if folder.is_dir():
+                for entry in os.scandir(folder.path):
+                    files += 1
+                    total_size += entry.stat().st_size
+        return files, total_size
+
+    def close(self):
+        self.conn.close()
+
+
+# SHA-256 of a file's content, read a block at a time
+def hash_file(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as hashed_file:
+        for block in iter(lambda: hashed_file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Thumbnails fit in a square of this many pixels (the pages show images at most 200px wide)
+THUMBNAIL_SIZE = 200
+
+
+# Makes a small jpeg thumbnail of an image (with Pillow) or of the first frame of a video (with ffmpeg)
+## source: the image or video
+## thumbnail_filename: path of the thumbnail to create
+## mime_type: the attachment's mime type
+## ffmpeg: path of the ffmpeg executable (only needed for videos)
+### returns: nothing, raises an exception if the thumbnail can't be made
+def make_thumbnail(source, thumbnail_filename, mime_type, ffmpeg=None):
+    temporary_filename = thumbnail_filename + '.' + str(os.getpid()) + '-' + str(threading.get_ident()) + '.part'
+    try:
+        if mime_type[:5] == 'image':
+            with Image.open(source) as image:
+                image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+                image.convert('RGB').save(temporary_filename, 'JPEG', quality=80)
+        else:
+            subprocess.run([ffmpeg, '-loglevel', 'error', '-y', '-i', source, '-frames:v', '1', '-vf', 'scale=' + str(THUMBNAIL_SIZE) + ':-2', '-f', 'image2', '-c:v', 'mjpeg', temporary_filename],
+                           check=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60)
+        os.replace(temporary_filename, thumbnail_filename)
+    finally:
+        if os.path.exists(temporary_filename):
+            os.remove(temporary_filename)
+
+
+# Places a copy of a file at the destination. The data is written to a temporary file and renamed into place, so an interrupted
+# export never leaves a half-written attachment behind that would later be mistaken for a complete one
+## source: the file to copy
+## destination: where the copy should end up
+## link_mode: 'copy', 'hardlink' or 'reflink'
+### returns: True if the data was copied, False if the destination is a link or clone of the source
+def place_file(source, destination, link_mode='copy'):
+    # Unique per process and thread, since several worker processes may be placing the same attachment at once
+    temporary_filename = destination + '.' + str(os.getpid()) + '-' + str(threading.get_ident()) + '.part'
+    copied = link_mode == 'copy'
+    try:
+        if link_mode == 'hardlink':
+            os.link(source, temporary_filename)
+        elif link_mode == 'reflink':
+            reflink_file(source, temporary_filename)
+        else:
+            shutil.copyfile(source, temporary_filename)
+    except OSError:
+        # Different filesystems, or the filesystem doesn't support links/clones. Just copy the data
+        if os.path.exists(temporary_filename):
+            os.remove(temporary_filename)
+        if link_mode == 'copy':
+            raise
+        shutil.copyfile(source, temporary_filename)
+        copied = True
+    os.replace(temporary_filename, destination)
+    return copied
+
+
+# Makes a copy-on-write clone of a file (clonefile on macOS/APFS, the FICLONE ioctl on Linux/btrfs/xfs)
+## source: the file to clone
+## destination: the new file to create
+### returns: nothing, raises OSError if cloning isn't supported
+def reflink_file(source, destination):
+    if sys.platform == 'darwin':
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.clonefile(source.encode('utf-8'), destination.encode('utf-8'), 0) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), destination)
+    elif sys.platform.startswith('linux'):
+        import fcntl
+        FICLONE = 0x40049409
+        with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+    else:
+        raise OSError('reflinks are not supported on ' + sys.platform)
+
+
+# Where iTunes/Finder keeps the iOS backups
+MOBILESYNC_BACKUP_FOLDER = os.path.expanduser('~/Library/Application Support/MobileSync/Backup')
 
 
 # Find the latest iTunes iOS backup
 ### returns: the file containing the latest iTunes iOS backup
 def get_latest_iOS_backup_path():
-    list_of_files = glob.glob(os.path.expanduser('~/Library/Application Support/MobileSync/Backup/')+'*')
+    list_of_files = glob.glob(MOBILESYNC_BACKUP_FOLDER + '/*')
     latest_file = max(list_of_files, key=os.path.getctime)
     return latest_file
 
 
+# Find every iOS backup in a folder
+## backups_folder: the folder holding the backups (e.g. MOBILESYNC_BACKUP_FOLDER)
+### returns: sorted list of the paths of the backups (folders with a Manifest.db or an sms.db)
+def find_iOS_backups(backups_folder):
+    return sorted(path for path in glob.glob(os.path.join(backups_folder, '*'))
+                  if os.path.exists(path + '/Manifest.db') or os.path.exists(BackupManifest(path, indexed=False).sms_db_path()))
+
+
+# Size of a backup's sms.db, to export the biggest backups first
+### returns: size in bytes (0 if it can't be found)
+def get_backup_sms_db_size(backup_path):
+    sms_db_path = BackupManifest(backup_path, indexed=False).sms_db_path()
+    return os.path.getsize(sms_db_path) if os.path.exists(sms_db_path) else 0
+
+
+# The name of the device a backup was made of, from the backup's Info.plist
+### returns: the device name, or None if the backup doesn't say
+def get_backup_device_name(backup_path):
+    try:
+        with open(backup_path + '/Info.plist', 'rb') as info_file:
+            return plistlib.load(info_file).get('Device Name')
+    except Exception:
+        return None
+
+
+# Closes off an html document
+HTML_FOOTER = '</body></html>'
+
+
 # Writes to file the html header information including css styling
 ## file: html file to write to
 def write_html_header(file):